@@ -1,9 +1,23 @@
 # A simple wireless simulation environment
-import paho.mqtt.client as mqtt
+try:
+        import paho.mqtt.client as mqtt
+except ImportError:
+        mqtt = None # only needed for GW_TRANSPORT = 'mqtt'
 from random import seed, randint
 from datetime import datetime
+from collections import OrderedDict, deque
+from array import array
+import atexit
+import base64
 import json
 import math
+import mmap
+import os
+import sqlite3
+import struct
+import sys
+import threading
+import time
 import simpy.rt
 
 RADIO_TXDISTANCE = 1.5  # transmissione range of nodes
@@ -11,6 +25,50 @@ RADIO_LOSSRATE   = 10 # 10% packet loss rate
 RADIO_CHANNEL    = 99  # selected transmission channel
 
 GW = 'Utz'
+GW_TRANSPORT = 'mqtt' # gateway uplink: 'mqtt' (paho), 'fake' (in-process broker) or 'file'
+GW_BROKER    = 'broker.hivemq.com'
+GW_PORT      = 1883
+GW_FILE      = 'uplink.txt' # written by the 'file' transport
+GW_POOL_SIZE = 2            # broker connections shared by all the sinks
+
+DEDUP_SIZE   = 256  # (SRC, SEQ) pairs remembered by every node
+DEDUP_WINDOW = 2000 # time a pair is remembered at most
+
+SENSOR_INTERVAL = (300, 500) # bounds of the time between two readings, changed by the 'interval' command
+SENSOR_BATCH    = 1          # readings per radio message, more than one are sent delta encoded in a SERIES message
+SENSOR_POLICY   = 'periodic' # 'periodic' sends every reading, 'deadband' only changes above SENSOR_DEADBAND,
+                             # 'heartbeat' also sends when nothing went out for SENSOR_HEARTBEAT
+SENSOR_DEADBAND  = 1         # change from the last sent value needed to send a reading
+SENSOR_HEARTBEAT = 3000      # time without a sent reading before one is sent anyway
+
+SENSOR_SOURCE = None # trace file replayed by the sensors instead of random temperatures, see write_trace
+TRACE_LOOP    = True # start over at the end of a column, otherwise fall back to random temperatures
+TRACE_STRIDE  = 0    # readings between the starting points of neighbouring node ids in a shared column
+
+PUB_BATCH    = True  # publish readings in batches instead of one message per reading
+PUB_MAX      = 50    # readings in a batch before it is flushed
+PUB_INTERVAL = 100   # time a reading waits in the batch at most
+PUB_COALESCE = False # keep only the latest reading of every node in a batch
+PUB_ENCODING = 'json' # batch payload: 'json' or 'delta' (binary, see encode_batch, on CS4628/<GW>/temp/delta)
+
+SERIES_SIZE     = 64    # readings kept per node at the sink
+SERIES_WINDOW   = 2000  # time covered by the rolling min/max/mean/count
+SERIES_PUBLISH  = False # publish the window of every node on CS4628/<GW>/aggregate
+SERIES_INTERVAL = 500   # time between two aggregate publishes
+
+BRIDGE_QUEUE_SIZE = 1000          # publishes waiting for the MQTT worker thread
+BRIDGE_POLICY     = 'drop_oldest' # when the queue is full: 'drop_oldest', 'drop_newest' or 'block'
+
+JOURNAL             = False                # keep uplink messages that could not be published on disk
+JOURNAL_FILE        = 'uplink_journal.db'  # one per connection, numbered
+JOURNAL_BATCH       = 50                   # journalled messages per commit
+JOURNAL_COMMIT_AGE  = 1.0                  # seconds a journalled message waits for its commit at most
+JOURNAL_REPLAY_RATE = 50                   # journalled messages replayed per second at most
+
+CMD_QUEUE_SIZE = 64 # commands from MQTT waiting for the simulation, newer ones are dropped when full
+CMD_POLL       = 10 # time between two looks at the command queue
+
+REPORT_INTERVAL = 1000 # time between two printouts of the reports, the gateway itself runs until stopped
 
 DEBUG_RADIO  = False #debug messages for the lowlevel radio True or False
 DEBUG_SENSOR = False #debug messages for the lowlevel sensors True or False
@@ -18,6 +76,129 @@ DEBUG_ADVERT = True  #debug messages for the advertisement
 DEBUG_ROUTE  = False #general routing info
 DEBUG_INFO   = False #general info messages
 
+# Series encoding: a count, then the first value and the differences
+# between neighbouring values, zigzag mapped (0, -1, 1, -2 -> 0, 1, 2, 3)
+# and written as varints of 7 bits per byte. Slowly changing integers
+# such as temperatures take one byte per value
+def put_varint(out, n):
+        while n >= 0x80:
+                out.append((n & 0x7f) | 0x80)
+                n >>= 7
+        out.append(n)
+
+def get_varint(data, pos):
+        n = 0
+        shift = 0
+        while True:
+                byte = data[pos]
+                pos += 1
+                n |= (byte & 0x7f) << shift
+                if byte < 0x80:
+                        return n, pos
+                shift += 7
+
+def encode_series(values, out=None):
+        out = bytearray() if out is None else out
+        put_varint(out, len(values))
+        last = 0
+        for value in values:
+                delta = int(value) - last
+                put_varint(out, (delta << 1) ^ (delta >> 63))
+                last = int(value)
+        return out
+
+def decode_series(data, pos=0):
+        # returns the values and the position after them
+        count, pos = get_varint(data, pos)
+        values = []
+        last = 0
+        for i in range(count):
+                n, pos = get_varint(data, pos)
+                last += (n >> 1) ^ -(n & 1)
+                values.append(last)
+        return values, pos
+
+def encode_batch(readings):
+        # [node, time, value] readings -> per node: node, times, values
+        nodes = OrderedDict()
+        for node_id, when, value in readings:
+                nodes.setdefault(node_id, ([], []))
+                nodes[node_id][0].append(when)
+                nodes[node_id][1].append(value)
+        out = bytearray()
+        put_varint(out, len(nodes))
+        for node_id, (times, values) in nodes.items():
+                put_varint(out, node_id)
+                encode_series(times, out)
+                encode_series(values, out)
+        return bytes(out)
+
+def decode_batch(data):
+        # the [node, time, value] readings of an encode_batch payload, grouped
+        # by node in the order the nodes first appear in the batch, the
+        # readings of a node in batch order
+        count, pos = get_varint(data, 0)
+        readings = []
+        for i in range(count):
+                node_id, pos = get_varint(data, pos)
+                times, pos = decode_series(data, pos)
+                values, pos = decode_series(data, pos)
+                readings.extend([node_id, when, value] for when, value in zip(times, values))
+        return readings
+
+# A recorded trace of readings: 'TRC1', the number of columns, an index
+# of (node id, byte offset, length) and then one float32 column per
+# recorded node (little endian). The file is memory mapped and the columns
+# are views into it, so only the pages being read end up in memory
+class Trace(object):
+        def __init__(self, path):
+                self.file = open(path, 'rb')
+                self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+                if self.map[:4] != b'TRC1':
+                        raise ValueError(path + ' is not a trace file')
+                count = struct.unpack_from('<I', self.map, 4)[0]
+                self.columns = OrderedDict()
+                for i in range(count):
+                        node_id, offset, length = struct.unpack_from('<IQI', self.map, 8 + 16 * i)
+                        self.columns[node_id] = memoryview(self.map)[offset:offset + 4 * length].cast('f')
+
+        def column(self, node_id):
+                # nodes that were not recorded get a column picked by their id
+                if node_id in self.columns:
+                        return self.columns[node_id]
+                ids = list(self.columns)
+                return self.columns[ids[node_id % len(ids)]]
+
+def write_trace(path, columns):
+        # columns maps node ids to their readings
+        with open(path, 'wb') as file:
+                file.write(b'TRC1' + struct.pack('<I', len(columns)))
+                offset = 8 + 16 * len(columns)
+                for node_id, values in columns.items():
+                        file.write(struct.pack('<IQI', node_id, offset, len(values)))
+                        offset += 4 * len(values)
+                for values in columns.values():
+                        column = array('f', values)
+                        if sys.byteorder == 'big':
+                                column.byteswap()
+                        file.write(column.tobytes())
+
+# Replays the column of one node from a Trace, starting at an offset
+class Replay(object):
+        def __init__(self, trace, node_id, offset=0, loop=TRACE_LOOP):
+                self.values = trace.column(node_id)
+                self.pos = offset % len(self.values) if len(self.values) else 0
+                self.loop = loop
+
+        def next(self):
+                if self.pos >= len(self.values):
+                        if not self.loop or not len(self.values):
+                                return None
+                        self.pos = 0
+                value = self.values[self.pos]
+                self.pos += 1
+                return value
+
 # The media, the wireless channel to communicate
 class Media(object):
         def __init__(self, env, capacity=simpy.core.Infinity):
@@ -35,6 +216,486 @@ class Media(object):
                         pipe = simpy.Store(self.env, capacity=self.capacity)
                         self.pipes.append(pipe)
                         return pipe
+# Recently seen (SRC, SEQ) pairs, bounded in size (least recently seen
+# pairs go first) and in time
+class Seen(object):
+        def __init__(self, env, size=DEDUP_SIZE, window=DEDUP_WINDOW):
+                self.env = env
+                self.size = size
+                self.window = window
+                self.entries = OrderedDict()
+                self.hits = 0
+                self.misses = 0
+
+        def check(self, src, seq):
+                # True if the pair was seen before, otherwise remember it
+                key = (src, seq)
+                now = self.env.now
+                seen = self.entries.get(key)
+                if seen is not None and now - seen <= self.window:
+                        self.hits += 1
+                        self.entries.move_to_end(key)
+                        return True
+                self.misses += 1
+                self.entries[key] = now
+                self.entries.move_to_end(key)
+                if len(self.entries) > self.size:
+                        self.entries.popitem(last=False)
+                return False
+
+        def footprint(self):
+                # approximate memory used by the cache in bytes
+                return sys.getsizeof(self.entries) + sum(sys.getsizeof(key) + sys.getsizeof(key[0]) + sys.getsizeof(key[1]) for key in self.entries)
+
+        def stats(self):
+                checks = self.hits + self.misses
+                return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / checks if checks else 0.0, 'entries': len(self.entries), 'bytes': self.footprint()}
+
+# A received message as handed to on_message by the transports that are not paho
+class Message(object):
+        def __init__(self, topic, payload):
+                self.topic = topic
+                self.payload = payload
+
+# Result of a publish, rc is 0 on success and 4 without a connection, as with paho
+class PublishResult(object):
+        def __init__(self, rc):
+                self.rc = rc
+
+def payload_size(payload):
+        # bytes on the wire, paho sends text as UTF-8 and numbers as text
+        if payload is None:
+                return 0
+        if isinstance(payload, (bytes, bytearray)):
+                return len(payload)
+        return len(str(payload).encode('utf-8'))
+
+# An in-process stand-in for the broker, with the part of the paho client
+# API the gateway uses. Every publish is recorded with a timestamp, other
+# clients are played by inject(), and disconnect()/reconnect() drop and
+# restore the connection
+class FakeBroker(object):
+        def __init__(self):
+                self.on_connect = None
+                self.on_message = None
+                self.connected = False
+                self.subscriptions = set()
+                self.published = [] # (time, topic, payload)
+                self.refused = 0
+                self.lock = threading.Lock()
+
+        def connect(self, host, port=1883, keepalive=60):
+                self.connected = True
+                if self.on_connect:
+                        self.on_connect(self, None, {}, 0)
+                return 0
+
+        def reconnect(self):
+                return self.connect(None)
+
+        def disconnect(self):
+                self.connected = False
+                return 0
+
+        def loop_start(self):
+                pass
+
+        def is_connected(self):
+                return self.connected
+
+        def subscribe(self, topic, qos=0):
+                self.subscriptions.add(topic)
+                return (0, 0)
+
+        def publish(self, topic, payload=None, qos=0, retain=False):
+                with self.lock:
+                        if not self.connected:
+                                self.refused += 1
+                                return PublishResult(4)
+                        self.published.append((time.monotonic(), topic, payload))
+                return PublishResult(0)
+
+        def inject(self, topic, payload):
+                if self.connected and topic in self.subscriptions and self.on_message:
+                        self.on_message(self, None, Message(topic, payload))
+
+        def stats(self):
+                with self.lock:
+                        messages = len(self.published)
+                        span = self.published[-1][0] - self.published[0][0] if messages > 1 else 0.0
+                        return {'messages': messages, 'bytes': sum(payload_size(p[2]) for p in self.published), 'refused': self.refused, 'rate': (messages - 1) / span if span else 0.0}
+
+# Writes every publish as a line "time topic payload" to a file, binary
+# payloads (PUB_ENCODING 'delta') base64 encoded after "b64:"
+class FileSink(FakeBroker):
+        def __init__(self, path=GW_FILE):
+                super().__init__()
+                self.file = open(path, 'a')
+
+        def publish(self, topic, payload=None, qos=0, retain=False):
+                with self.lock:
+                        if not self.connected:
+                                self.refused += 1
+                                return PublishResult(4)
+                        now = time.monotonic()
+                        self.published.append((now, topic, payload_size(payload)))
+                        if isinstance(payload, (bytes, bytearray)):
+                                payload = 'b64:' + base64.b64encode(payload).decode('ascii')
+                        self.file.write('%.6f %s %s\n' % (now, topic, payload))
+                        self.file.flush()
+                return PublishResult(0)
+
+        def stats(self):
+                stats = super().stats()
+                with self.lock:
+                        stats['bytes'] = sum(p[2] for p in self.published)
+                return stats
+
+def uplink(kind=GW_TRANSPORT):
+        # the client the gateway publishes through
+        if kind == 'mqtt':
+                if mqtt is None:
+                        raise RuntimeError("paho-mqtt is not installed, use GW_TRANSPORT = 'fake' or 'file'")
+                return mqtt.Client(client_id="", clean_session=True, userdata=None, transport="tcp")
+        elif kind == 'fake':
+                return FakeBroker()
+        elif kind == 'file':
+                return FileSink(GW_FILE)
+        raise ValueError('unknown gateway transport ' + str(kind))
+
+# Append-only SQLite journal of uplink messages that could not be
+# published, kept across restarts and replayed in order. Only the bridge
+# worker writes to it; commits are batched, JOURNAL_BATCH rows at a time
+# or once the oldest row waited JOURNAL_COMMIT_AGE, and what is left is
+# committed when the gateway exits. A crash loses at most the rows of
+# the last JOURNAL_COMMIT_AGE
+class Journal(object):
+        def __init__(self, path=JOURNAL_FILE, batch=JOURNAL_BATCH):
+                self.path = path
+                self.batch = batch
+                self.db = sqlite3.connect(path, check_same_thread=False)
+                self.db.execute('CREATE TABLE IF NOT EXISTS uplink (id INTEGER PRIMARY KEY AUTOINCREMENT, topic TEXT, payload BLOB)')
+                self.db.commit()
+                self.lock = threading.Lock()
+                self.pending = self.db.execute('SELECT COUNT(*) FROM uplink').fetchone()[0]
+                self.uncommitted = 0
+                self.oldest = None # time of the oldest uncommitted change
+                self.appended = 0
+                self.replayed = 0
+                self.replay_first = None
+                self.replay_last = None
+                self.commits = 0
+                self.commit_time = 0.0
+                atexit.register(self.shutdown)
+
+        def append(self, topic, payload):
+                with self.lock:
+                        # stored as given, binary payloads (PUB_ENCODING 'delta') come back as bytes
+                        self.db.execute('INSERT INTO uplink (topic, payload) VALUES (?, ?)', (topic, payload))
+                        self.pending += 1
+                        self.appended += 1
+                        self.changed()
+                        if self.uncommitted >= self.batch:
+                                self.commit()
+
+        def changed(self):
+                # called with the lock held
+                if not self.uncommitted:
+                        self.oldest = time.monotonic()
+                self.uncommitted += 1
+
+        def commit(self):
+                # called with the lock held
+                if self.uncommitted:
+                        start = time.monotonic()
+                        self.db.commit()
+                        self.commit_time += time.monotonic() - start
+                        self.commits += 1
+                        self.uncommitted = 0
+
+        def flush(self, age=JOURNAL_COMMIT_AGE):
+                # commit a batch that is not full yet once it waited long enough
+                with self.lock:
+                        if self.uncommitted and time.monotonic() - self.oldest >= age:
+                                self.commit()
+
+        def shutdown(self):
+                with self.lock:
+                        self.commit()
+
+        def first(self):
+                with self.lock:
+                        return self.db.execute('SELECT id, topic, payload FROM uplink ORDER BY id LIMIT 1').fetchone()
+
+        def remove(self, id):
+                with self.lock:
+                        now = time.monotonic()
+                        if self.replay_first is None:
+                                self.replay_first = now
+                        self.replay_last = now
+                        self.db.execute('DELETE FROM uplink WHERE id = ?', (id,))
+                        self.pending -= 1
+                        self.replayed += 1
+                        self.changed()
+                        if self.uncommitted >= self.batch or self.pending == 0:
+                                self.commit()
+
+        def stats(self):
+                with self.lock:
+                        return {'pending': self.pending, 'bytes': os.path.getsize(self.path), 'appended': self.appended, 'replayed': self.replayed, 'replay_rate': (self.replayed - 1) / (self.replay_last - self.replay_first) if self.replayed > 1 and self.replay_last > self.replay_first else 0.0, 'commits': self.commits, 'commit_cost': self.commit_time / self.commits if self.commits else 0.0}
+
+# Hands publishes over to a worker thread through a bounded queue, so a
+# slow broker or a full socket never holds up the simulation
+class Bridge(object):
+        def __init__(self, client, size=BRIDGE_QUEUE_SIZE, policy=BRIDGE_POLICY, journal=None):
+                if policy not in ('drop_oldest', 'drop_newest', 'block'):
+                        raise ValueError('unknown bridge policy ' + str(policy))
+                self.client = client
+                self.size = size
+                self.policy = policy
+                self.journal = journal
+                self.next_replay = 0.0
+                self.queue = deque()
+                self.cond = threading.Condition()
+                self.enqueued = 0
+                self.published = 0
+                self.failed = 0
+                self.dropped = 0
+                self.depth_sum = 0
+                self.max_depth = 0
+                self.latency_sum = 0.0
+                self.max_latency = 0.0
+                self.thread = threading.Thread(target=self.worker, daemon=True)
+                self.thread.start()
+
+        def publish(self, topic, payload):
+                with self.cond:
+                        if len(self.queue) >= self.size:
+                                if self.policy == 'drop_newest':
+                                        self.dropped += 1
+                                        return
+                                elif self.policy == 'drop_oldest':
+                                        self.queue.popleft()
+                                        self.dropped += 1
+                                else:
+                                        while len(self.queue) >= self.size:
+                                                self.cond.wait()
+                        self.queue.append((time.monotonic(), topic, payload))
+                        self.enqueued += 1
+                        self.depth_sum += len(self.queue)
+                        self.max_depth = max(self.max_depth, len(self.queue))
+                        self.cond.notify_all()
+
+        def replaying(self):
+                # journalled messages only go out while nothing live is waiting,
+                # the broker is reachable and the replay rate allows it
+                return self.journal is not None and self.journal.pending > 0 and time.monotonic() >= self.next_replay and self.client.is_connected()
+
+        def replay(self):
+                start = time.monotonic()
+                row = self.journal.first()
+                if row is not None and self.client.publish(row[1], row[2]).rc == 0:
+                        self.journal.remove(row[0])
+                self.next_replay = start + 1.0 / JOURNAL_REPLAY_RATE
+
+        def worker(self):
+                while True:
+                        if self.journal is not None:
+                                self.journal.flush()
+                        with self.cond:
+                                while not self.queue and not self.replaying():
+                                        self.cond.wait(None if self.journal is None else 1.0 / JOURNAL_REPLAY_RATE)
+                                        if self.journal is not None:
+                                                self.journal.flush()
+                                item = self.queue.popleft() if self.queue else None
+                                self.cond.notify_all()
+                        if item is None:
+                                self.replay()
+                                continue
+                        queued, topic, payload = item
+                        ok = self.client.publish(topic, payload).rc == 0
+                        if not ok and self.journal is not None:
+                                self.journal.append(topic, payload)
+                        latency = time.monotonic() - queued
+                        with self.cond:
+                                if ok:
+                                        self.published += 1
+                                        self.latency_sum += latency
+                                        self.max_latency = max(self.max_latency, latency)
+                                else:
+                                        self.failed += 1
+
+        def stats(self):
+                with self.cond:
+                        return {'enqueued': self.enqueued, 'published': self.published, 'failed': self.failed, 'dropped': self.dropped, 'depth': len(self.queue), 'mean_depth': self.depth_sum / self.enqueued if self.enqueued else 0.0, 'max_depth': self.max_depth, 'mean_latency': self.latency_sum / self.published if self.published else 0.0, 'max_latency': self.max_latency}
+
+# The last SERIES_SIZE readings of one node as (time, value, hops) columns
+# in a ring, with min/max/mean/count over the last SERIES_WINDOW kept up to
+# date as readings come and go. Readings are numbered from the first one;
+# start is the oldest reading still in the window, and mins/maxs hold the
+# numbers of the candidates for the window minimum and maximum
+class Series(object):
+        def __init__(self, size=SERIES_SIZE, window=SERIES_WINDOW):
+                self.size = size
+                self.window = window
+                self.time = array('d', [0.0] * size)
+                self.value = array('d', [0.0] * size)
+                self.hops = array('H', [0] * size)
+                self.total = 0
+                self.start = 0
+                self.sum = 0.0
+                self.mins = deque()
+                self.maxs = deque()
+
+        def add(self, now, value, hops):
+                # the reading about to be overwritten leaves the window first
+                if self.total - self.start == self.size:
+                        self.drop()
+                n = self.total
+                slot = n % self.size
+                self.time[slot] = now
+                self.value[slot] = value
+                self.hops[slot] = hops
+                self.total += 1
+                self.sum += value
+                while self.mins and self.value[self.mins[-1] % self.size] >= value:
+                        self.mins.pop()
+                self.mins.append(n)
+                while self.maxs and self.value[self.maxs[-1] % self.size] <= value:
+                        self.maxs.pop()
+                self.maxs.append(n)
+                self.expire(now)
+
+        def drop(self):
+                self.sum -= self.value[self.start % self.size]
+                if self.mins[0] == self.start:
+                        self.mins.popleft()
+                if self.maxs[0] == self.start:
+                        self.maxs.popleft()
+                self.start += 1
+
+        def expire(self, now):
+                while self.start < self.total and self.time[self.start % self.size] < now - self.window:
+                        self.drop()
+
+        def stats(self, now):
+                self.expire(now)
+                count = self.total - self.start
+                if count == 0:
+                        return {'count': 0, 'min': None, 'max': None, 'mean': None}
+                return {'count': count, 'min': self.value[self.mins[0] % self.size], 'max': self.value[self.maxs[0] % self.size], 'mean': self.sum / count}
+
+        def readings(self):
+                # (time, value, hops) of the readings in the ring, oldest first
+                first = max(0, self.total - self.size)
+                return [(self.time[n % self.size], self.value[n % self.size], self.hops[n % self.size]) for n in range(first, self.total)]
+
+        def footprint(self):
+                return sum(sys.getsizeof(column) for column in (self.time, self.value, self.hops)) + sys.getsizeof(self.mins) + sys.getsizeof(self.maxs)
+
+# A broker connection shared by several sinks: one client, one bridge
+# worker, and the command topics dispatched to the sink that owns them
+class Connection(object):
+        def __init__(self, index):
+                self.index = index
+                self.sinks = []
+                self.handlers = {} # topic -> on_message of the sink
+                self.client = uplink()
+                self.client.on_connect = self.on_connect
+                self.client.on_message = self.on_message
+                journal = None
+                if JOURNAL:
+                        root, ext = os.path.splitext(JOURNAL_FILE)
+                        journal = Journal(root + '_' + str(index) + ext)
+                self.bridge = Bridge(self.client, journal=journal)
+                self.client.connect(GW_BROKER, GW_PORT, 60)
+                self.client.loop_start()
+
+        def attach(self, sink):
+                self.sinks.append(sink)
+                self.handlers["CS4628/" + sink.gw + "/command"] = sink.on_message
+                # sinks attached after the connection came up announce themselves now
+                if self.client.is_connected():
+                        sink.on_connect(self.client, None, {}, 0)
+
+        def on_connect(self, client, userdata, flags, rc):
+                for sink in list(self.sinks):
+                        sink.on_connect(client, userdata, flags, rc)
+
+        def on_message(self, client, userdata, msg):
+                handler = self.handlers.get(msg.topic)
+                if handler:
+                        handler(client, userdata, msg)
+                else:
+                        print("<-: "+msg.topic+" no sink for this topic")
+
+# Up to GW_POOL_SIZE connections, opened as sinks ask for them; a sink
+# gets a new connection while the pool is not full, then the least used one
+class Pool(object):
+        def __init__(self, size=GW_POOL_SIZE):
+                self.size = size
+                self.connections = []
+
+        def connection(self):
+                if len(self.connections) < self.size:
+                        self.connections.append(Connection(len(self.connections)))
+                        return self.connections[-1]
+                return min(self.connections, key=lambda connection: len(connection.sinks))
+
+pool = Pool()
+
+# Buffers readings and publishes them as one batch per CS4628/<GW>/temp
+# message, flushed when PUB_MAX readings are waiting or every PUB_INTERVAL
+class Publisher(object):
+        def __init__(self, env, client, gw):
+                self.env = env
+                self.client = client
+                self.gw = gw
+                self.topic = "CS4628/" + gw + "/temp"
+                self.pending = OrderedDict()  # (node, SEQ) or node when coalescing -> [node, time, value]
+                self.readings = 0
+                self.coalesced = 0
+                self.messages = 0
+                self.bytes = 0
+                env.process(self.flush_p())
+
+        def add(self, node_id, value, when=None):
+                # forwarders pass DATA on as a string, the batch holds numbers only
+                value = float(value)
+                self.readings += 1
+                if PUB_COALESCE:
+                        if node_id in self.pending:
+                                self.coalesced += 1
+                                del self.pending[node_id]
+                        key = node_id
+                else:
+                        key = (node_id, self.readings)
+                self.pending[key] = [node_id, self.env.now if when is None else when, value]
+                if len(self.pending) >= PUB_MAX:
+                        self.flush()
+
+        def flush(self):
+                if not self.pending:
+                        return
+                if PUB_ENCODING == 'delta':
+                        topic = self.topic + "/delta"
+                        payload = encode_batch([[node_id, int(when), int(float(value))] for node_id, when, value in self.pending.values()])
+                else:
+                        topic = self.topic
+                        payload = json.dumps({'gw': self.gw, 't': self.env.now, 'readings': list(self.pending.values())}, separators=(',', ':'))
+                self.pending.clear()
+                self.messages += 1
+                self.bytes += len(payload)
+                self.client.publish(topic, payload)
+
+        def flush_p(self):
+                while True:
+                        yield self.env.timeout(PUB_INTERVAL)
+                        self.flush()
+
+        def stats(self):
+                return {'readings': self.readings, 'coalesced': self.coalesced, 'messages': self.messages, 'bytes': self.bytes, 'per_message': (self.readings - self.coalesced) / self.messages if self.messages else 0.0, 'per_reading': self.bytes / (self.readings - self.coalesced) if self.readings > self.coalesced else 0.0}
+
 # A node, providing basic sensing and communication API
 class Node(object):
         def __init__(self, env, media, id, posx, posy):
@@ -47,11 +708,21 @@ class Node(object):
                 self.posy = posy
                 self.sqnr = 0
                 self.rank = 0
+                self.root = 0
+                self.seen = Seen(env)
+                self.source = None
+                self.routes = {}      # downward routes, destination -> next hop
+                self.commands = []    # (command, latency, hops) of the commands applied here
+                self.cmd_frames = 0   # CMD frames sent by this node
                 env.process(self.main_p())
                 env.process(self.receive_p())
 
         def temperature(self):
-                temp = randint(27, 35)
+                temp = self.source.next() if self.source else None
+                if temp is None:
+                        temp = randint(27, 35)
+                else:
+                        temp = int(round(temp)) # whole degrees, like the micro:bit
                 if (DEBUG_SENSOR):
                         print(self.env.now,':', self.id,'sensing temperature of', temp)
                 return temp
@@ -89,34 +760,156 @@ class Node(object):
                                 print(self.env.now,':', self.id,'X (dst)', msg[2], 'distance', distance)
                         return None
 
+        def learn_route(self, msg_json):
+                # a reading coming up from below tells us which neighbour leads to its source
+                self.routes[msg_json['SRC']] = msg_json['LSRC']
+                self.routes[msg_json['LSRC']] = msg_json['LSRC']
+
+        def route_command(self, msg_json, flood):
+                # flood a command to the nodes below, or pass it on towards its destination
+                if flood:
+                        if not self.routes:
+                                return
+                        msg_json['LDST'] = 0
+                elif msg_json['DST'] in self.routes:
+                        msg_json['LDST'] = self.routes[msg_json['DST']]
+                else:
+                        print(self.env.now,':', self.id ,'no route for command to', msg_json['DST'])
+                        return
+                msg_json['LSRC'] = self.id
+                msg_json['HOPS'] += 1
+                msg_str = json.dumps( msg_json )
+                if (DEBUG_ROUTE):
+                        print(self.env.now,':', self.id ,'routing command' , msg_str)
+                self.cmd_frames += 1
+                self.send(msg_json['LDST'],msg_str)
+
 
 # A sink node
 class Sink(Node):
         def on_message(self, client, userdata, msg):
+                # runs on the MQTT network thread: only parse and queue here, the
+                # simulation picks the command up in command_p
                 print("<-: "+msg.topic+" "+str(msg.payload))
-                
+                # e.g. {"scope": "node", "dst": 5, "cmd": "interval", "arg": [100, 200]}
+                try:
+                        cmd = json.loads(msg.payload)
+                        cmd = (cmd.get('scope', 'all'), cmd.get('dst', 0), cmd['cmd'], cmd.get('arg'))
+                except (ValueError, KeyError, TypeError, AttributeError) as e:
+                        print("malformed command: "+str(e))
+                        return
+                error = self.check_command(*cmd)
+                if error:
+                        print("rejected command: "+error)
+                        self.inbox_rejected += 1
+                        return
+                # deque appends are atomic and there is a single producer, so the
+                # length check cannot let the queue grow past its bound
+                if len(self.inbox) >= CMD_QUEUE_SIZE:
+                        self.inbox_dropped += 1
+                        return
+                self.inbox.append((time.monotonic(), cmd))
 
         def on_connect(self, client, userdata, flags, rc):
-                print("connected to MQTT: "+str(rc))
+                print("connected to MQTT: "+str(rc)+" "+self.gw)
 
-                client.publish("CS4628/" + GW + "/maintenance", "gateway start")
-                client.subscribe("CS4628/" + GW + "/command")
+                client.publish("CS4628/" + self.gw + "/maintenance", "gateway start")
+                client.subscribe("CS4628/" + self.gw + "/command")
 
-        def __init__(self, env, media, id, posx, posy):
+        def __init__(self, env, media, id, posx, posy, gw=GW):
                 super().__init__(env, media, id, posx, posy)
+                self.gw = gw
                 self.switch = False;
                 self.channel = RADIO_CHANNEL
                 self.rank = 1
+                self.root = self.id
+                self.cmd_issued = 0
+                self.inbox = deque()
+                self.inbox_dropped = 0
+                self.inbox_rejected = 0
+                self.inbox_wait = []  # seconds from MQTT arrival to the command being sent
+                env.process(self.command_p())
                 print(self.env.now,':', self.id,'new sink node (', self.posx,'|', self.posy,')')
-                self.mqttc = mqtt.Client(client_id="", clean_session=True, userdata=None, transport="tcp")
-                self.mqttc.on_connect = self.on_connect
-                self.mqttc.on_message = self.on_message
-                self.mqttc.connect('broker.hivemq.com', 1883, 60)
-                self.mqttc.loop_start()
+                self.connection = pool.connection()
+                self.mqttc = self.connection.client
+                self.bridge = self.connection.bridge
+                self.publisher = Publisher(env, self.bridge, self.gw)
+                self.connection.attach(self)
+                self.series = {} # node -> Series of its readings
+                self.reporting = {} # node -> [readings received, suppressed, summed error of the suppressed]
+                if SERIES_PUBLISH:
+                        env.process(self.series_p())
 
-        def publish(self, client, message, node_id, type):
+        def window(self, node_id):
+                # min/max/mean/count of the recent readings of a node
+                if node_id not in self.series:
+                        return None
+                return self.series[node_id].stats(self.env.now)
+
+        def series_p(self):
+                while True:
+                        yield self.env.timeout(SERIES_INTERVAL)
+                        windows = {}
+                        for node_id in self.series:
+                                windows[node_id] = self.window(node_id)
+                        if windows:
+                                self.bridge.publish("CS4628/" + self.gw + "/aggregate", json.dumps({'t': self.env.now, 'window': SERIES_WINDOW, 'nodes': windows}, separators=(',', ':')))
+
+        def publish(self, client, message, node_id, type, when=None):
           if type == 'TEMP':
-              client.publish("CS4628/" + GW + "/"+ str(node_id) + "/temp" ,message)
+              if PUB_BATCH:
+                  self.publisher.add(node_id, message, when)
+              else:
+                  client.publish("CS4628/" + self.gw + "/"+ str(node_id) + "/temp" ,message)
+
+        def command_p(self):
+                while True:
+                        yield self.env.timeout(CMD_POLL)
+                        while self.inbox:
+                                arrival, cmd = self.inbox.popleft()
+                                self.inbox_wait.append(time.monotonic() - arrival)
+                                self.command(*cmd)
+
+        def check_command(self, scope, dst, cmd, arg):
+                # the command topic is on a public broker, anything that would
+                # not apply cleanly on the sensors is turned away here
+                if scope not in ('node', 'subtree', 'all'):
+                        return 'unknown scope ' + str(scope)
+                if scope != 'all' and (not isinstance(dst, int) or isinstance(dst, bool)):
+                        return 'destination must be a node id'
+                if scope == 'node' and dst == self.id:
+                        return 'the sink itself takes no commands'
+                if cmd == 'interval':
+                        if not isinstance(arg, list) or len(arg) != 2 or not all(isinstance(n, int) and not isinstance(n, bool) and n >= 0 for n in arg):
+                                return 'interval needs two non-negative integers'
+                        if arg[0] > arg[1] or arg[1] == 0:
+                                return 'interval needs a lower bound not above a positive upper bound'
+                        return None
+                return 'unknown command ' + str(cmd)
+
+        def command(self, scope, dst, cmd, arg):
+                # send a command down the tree to one node ('node'), a node and
+                # everything below it ('subtree') or every node ('all')
+                error = self.check_command(scope, dst, cmd, arg)
+                if error:
+                        print(self.env.now,':', self.id ,'rejected command', error)
+                        return
+                self.sqnr += 1
+                self.cmd_issued += 1
+                msg_json = {}
+                msg_json['TYPE'] = 'CMD'
+                msg_json['SRC']  = self.id
+                msg_json['DST']  = dst
+                msg_json['LSRC'] = self.id
+                msg_json['LDST'] = 0
+                msg_json['SEQ']  = self.sqnr
+                msg_json['SCOPE'] = scope
+                msg_json['CMD']  = cmd
+                msg_json['ARG']  = arg
+                msg_json['OT']   = self.env.now
+                msg_json['HOPS'] = 0
+                # only 'all' and a subtree rooted at the sink are flooded from here
+                self.route_command(msg_json, scope == 'all' or (scope == 'subtree' and dst == self.id))
 
         def main_p(self):
                 while True:
@@ -130,6 +923,7 @@ class Sink(Node):
                         msg_json['LSRC'] = self.id
                         msg_json['LDST'] = 0
                         msg_json['RNK'] = self.rank
+                        msg_json['ROOT'] = self.root
                         msg_json['SEQ']  = self.sqnr
                         msg_str = json.dumps( msg_json )
                         if (DEBUG_ADVERT):
@@ -145,9 +939,32 @@ class Sink(Node):
                                 if (DEBUG_INFO):
                                         print(self.env.now,':', self.id ,'sink, receiving' , msg_str)
                                 msg_json = json.loads(msg_str)
-                                if msg_json['TYPE'] == 'TEMP':
-                                        print(self.env.now,':', self.id ,'sensor',msg_json['SRC'],'reports', msg_json['DATA'])
-                                        self.publish(self.mqttc, msg_json['DATA'], msg_json['SRC'], msg_json['TYPE'])
+                                if msg_json['TYPE'] in ('TEMP', 'SERIES'):
+                                        if self.seen.check(msg_json['SRC'], msg_json['SEQ']):
+                                                if (DEBUG_ROUTE):
+                                                        print(self.env.now,':', self.id ,'dropping duplicate' , msg_str)
+                                                continue
+                                        self.learn_route(msg_json)
+                                        if msg_json['SRC'] not in self.reporting:
+                                                self.reporting[msg_json['SRC']] = [0, 0, 0]
+                                        self.reporting[msg_json['SRC']][1] += msg_json.get('SUP', 0)
+                                        self.reporting[msg_json['SRC']][2] += msg_json.get('ERR', 0)
+                                        if msg_json['TYPE'] == 'TEMP':
+                                                self.reading(msg_json['SRC'], self.env.now, msg_json['DATA'], msg_json['HOPS'] + 1)
+                                        else:
+                                                data = base64.b64decode(msg_json['ENC'])
+                                                times, pos = decode_series(data)
+                                                values, pos = decode_series(data, pos)
+                                                for when, value in zip(times, values):
+                                                        self.reading(msg_json['SRC'], when, value, msg_json['HOPS'] + 1)
+
+        def reading(self, src, when, value, hops):
+                print(self.env.now,':', self.id ,'sensor',src,'reports', value)
+                self.reporting[src][0] += 1
+                if src not in self.series:
+                        self.series[src] = Series()
+                self.series[src].add(when, float(value), hops)
+                self.publish(self.bridge, value, src, 'TEMP', when)
 
 
 
@@ -157,28 +974,42 @@ class Sensor(Node):
         def __init__(self, env, media, id, posx, posy):
                 super().__init__(env, media, id, posx, posy)
                 self.join_node = 0
+                self.interval = SENSOR_INTERVAL
+                if trace:
+                        self.source = Replay(trace, self.id, self.id * TRACE_STRIDE)
+                if SENSOR_POLICY not in ('periodic', 'deadband', 'heartbeat'):
+                        raise ValueError('unknown reporting policy ' + str(SENSOR_POLICY))
+                self.batch = [] # (time, value) readings waiting for a SERIES message
+                self.last_sent = None      # (time, value) of the last reading sent
+                self.sent = 0
+                self.suppressed = 0
+                self.sup = 0               # readings suppressed since the last message
+                self.err = 0               # and their summed distance to the value the sink holds
+                self.data_readings = 0
+                self.data_bytes = 0
                 print(self.env.now,':', self.id,'new sensor node (', self.posx,'|', self.posy,')')
 
+        def apply_command(self, msg_json):
+                latency = self.env.now - msg_json['OT']
+                self.commands.append((msg_json['CMD'], latency, msg_json['HOPS']))
+                print(self.env.now,':', self.id ,'command', msg_json['CMD'], msg_json['ARG'], 'latency', latency, 'hops', msg_json['HOPS'])
+                if msg_json['CMD'] == 'interval':
+                        self.interval = (int(msg_json['ARG'][0]), int(msg_json['ARG'][1]))
+                else:
+                        print(self.env.now,':', self.id ,'unknown command', msg_json['CMD'])
+
         def main_p(self):
                 while True:
-                        yield self.env.timeout(randint(300, 500))
+                        yield self.env.timeout(randint(self.interval[0], self.interval[1]))
                         if self.join_node == 0:
                                 print(self.env.now,':', self.id ,'cannot send messages, not joined a topology yet')
                         else:
                                 # send a temperature message to the sink
-                                self.sqnr += 1
-                                msg_json = {}
-                                msg_json['TYPE'] = 'TEMP'
-                                msg_json['SRC']  = self.id
-                                msg_json['DST']  = 1
-                                msg_json['LSRC'] = self.id
-                                msg_json['LDST'] = self.join_node
-                                msg_json['SEQ']  = self.sqnr
-                                msg_json['DATA'] = self.temperature()
-                                msg_str = json.dumps( msg_json )
-                                if (DEBUG_INFO):
-                                        print(self.env.now,':', self.id ,'sending sensor reading' , msg_str)
-                                self.send(msg_json['LDST'],msg_str)
+                                value = self.temperature()
+                                if self.report(value):
+                                        self.batch.append((self.env.now, value))
+                                if self.batch and len(self.batch) >= SENSOR_BATCH:
+                                        self.send_readings()
 
                                 # send a join message to all around me
                                 self.sqnr += 1
@@ -189,6 +1020,7 @@ class Sensor(Node):
                                 msg_json['LSRC'] = self.id
                                 msg_json['LDST'] = 0
                                 msg_json['RNK'] = self.rank
+                                msg_json['ROOT'] = self.root
                                 msg_json['SEQ']  = self.sqnr
                                 msg_str = json.dumps( msg_json )
                                 if (DEBUG_ADVERT):
@@ -197,6 +1029,48 @@ class Sensor(Node):
 
 
 
+        def report(self, value):
+                # decide whether a reading goes out; the sink holds on to the last
+                # value it got, so a suppressed reading costs |value - last sent|
+                now = self.env.now
+                if SENSOR_POLICY == 'periodic' or self.last_sent is None or abs(value - self.last_sent[1]) > SENSOR_DEADBAND or (SENSOR_POLICY == 'heartbeat' and now - self.last_sent[0] >= SENSOR_HEARTBEAT):
+                        self.last_sent = (now, value)
+                        self.sent += 1
+                        return True
+                self.suppressed += 1
+                self.sup += 1
+                self.err += abs(value - self.last_sent[1])
+                return False
+
+        def send_readings(self):
+                self.sqnr += 1
+                msg_json = {}
+                msg_json['SRC']  = self.id
+                msg_json['DST']  = self.root
+                msg_json['LSRC'] = self.id
+                msg_json['LDST'] = self.join_node
+                msg_json['SEQ']  = self.sqnr
+                if len(self.batch) == 1:
+                        msg_json['TYPE'] = 'TEMP'
+                        msg_json['DATA'] = self.batch[0][1]
+                else:
+                        msg_json['TYPE'] = 'SERIES'
+                        data = encode_series([reading[1] for reading in self.batch], encode_series([reading[0] for reading in self.batch]))
+                        msg_json['ENC'] = base64.b64encode(data).decode('ascii')
+                msg_json['HOPS'] = 0
+                if SENSOR_POLICY != 'periodic':
+                        msg_json['SUP'] = self.sup
+                        msg_json['ERR'] = self.err
+                        self.sup = 0
+                        self.err = 0
+                msg_str = json.dumps( msg_json )
+                self.data_readings += len(self.batch)
+                self.data_bytes += len(msg_str)
+                self.batch = []
+                if (DEBUG_INFO):
+                        print(self.env.now,':', self.id ,'sending sensor reading' , msg_str)
+                self.send(msg_json['LDST'],msg_str)
+
         def receive_p(self):
                 while True:
                         msg = yield self.media_in.get()
@@ -211,6 +1085,7 @@ class Sensor(Node):
                                                         print(self.env.now,':', self.id ,'joining node' , msg_json['SRC'], 'rank:', self.rank, '->', msg_json['RNK'] + 1)
                                                 self.join_node = msg_json['SRC']
                                                 self.rank = msg_json['RNK'] + 1
+                                                self.root = msg_json['ROOT']
                                         else:
                                                 if (DEBUG_ADVERT):
                                                         print(self.env.now,':', self.id ,'join received for rank' , msg_json['RNK'] )
@@ -219,18 +1094,115 @@ class Sensor(Node):
                                                                 print(self.env.now,':', self.id ,'joining node' , msg_json['SRC'], 'rank:', self.rank, '->', msg_json['RNK'] + 1)
                                                         self.join_node = msg_json['SRC']
                                                         self.rank = msg_json['RNK'] + 1
-                                elif msg_json['TYPE'] == 'TEMP':
+                                                        self.root = msg_json['ROOT']
+                                elif msg_json['TYPE'] in ('TEMP', 'SERIES'):
                                         if self.join_node == 0:
                                                 print(self.env.now,':', self.id ,'cannot route messages, not joined a topology yet')
+                                        elif self.seen.check(msg_json['SRC'], msg_json['SEQ']):
+                                                if (DEBUG_ROUTE):
+                                                        print(self.env.now,':', self.id ,'dropping duplicate' , msg_str)
                                         else:
+                                                self.learn_route(msg_json)
                                                 msg_json['LSRC'] = self.id
                                                 msg_json['LDST'] = self.join_node
-                                                msg_json['DATA'] = str(msg_json['DATA'])
+                                                if msg_json['TYPE'] == 'TEMP':
+                                                        msg_json['DATA'] = str(msg_json['DATA'])
+                                                msg_json['HOPS'] += 1
                                                 msg_str = json.dumps( msg_json )
                                                 if (DEBUG_ROUTE):
                                                         print(self.env.now,':', self.id ,'routing' , msg_str)
                                                 self.send(msg_json['LDST'],msg_str)
+                                elif msg_json['TYPE'] == 'CMD':
+                                        # flooded commands are only taken from the parent
+                                        if msg_json['LDST'] == 0 and msg_json['LSRC'] != self.join_node:
+                                                continue
+                                        if self.seen.check(msg_json['SRC'], msg_json['SEQ']):
+                                                if (DEBUG_ROUTE):
+                                                        print(self.env.now,':', self.id ,'dropping duplicate' , msg_str)
+                                                continue
+                                        flood = msg_json['LDST'] == 0 or (msg_json['SCOPE'] == 'subtree' and msg_json['DST'] == self.id)
+                                        if flood or msg_json['DST'] == self.id:
+                                                self.apply_command(msg_json)
+                                        if flood or msg_json['DST'] != self.id:
+                                                self.route_command(msg_json, flood)
+
+
+def command_report(nodes):
+        issued = sum(node.cmd_issued for node in nodes if isinstance(node, Sink))
+        frames = sum(node.cmd_frames for node in nodes)
+        applied = [c for node in nodes for c in node.commands]
+        print('commands issued', issued, 'applied', len(applied), 'frames', frames)
+        for node in nodes:
+                if isinstance(node, Sink) and (node.inbox_wait or node.inbox_dropped or node.inbox_rejected):
+                        wait = node.inbox_wait
+                        print('  sink', node.id, 'queued', len(wait), 'dropped', node.inbox_dropped, 'rejected', node.inbox_rejected, 'mean wait %.1f ms, max wait %.1f ms' % (1000 * sum(wait) / len(wait) if wait else 0.0, 1000 * max(wait) if wait else 0.0))
+        if applied:
+                print('  frames per delivery %.2f, mean hops %.2f, mean latency %.2f, max latency %.2f' % (frames / len(applied), sum(c[2] for c in applied) / len(applied), sum(c[1] for c in applied) / len(applied), max(c[1] for c in applied)))
+
+
+def encoding_report(nodes):
+        readings = sum(node.data_readings for node in nodes if isinstance(node, Sensor))
+        radio = sum(node.data_bytes for node in nodes if isinstance(node, Sensor))
+        if readings:
+                print('radio: readings', readings, 'bytes', radio, 'bytes per reading %.1f' % (radio / readings))
+        for node in nodes:
+                if isinstance(node, Sink) and PUB_BATCH:
+                        stats = node.publisher.stats()
+                        print('uplink', node.gw, PUB_ENCODING, 'bytes per reading %.1f' % stats['per_reading'])
+
 
+def reporting_report(nodes):
+        sent = sum(node.sent for node in nodes if isinstance(node, Sensor))
+        suppressed = sum(node.suppressed for node in nodes if isinstance(node, Sensor))
+        print('policy', SENSOR_POLICY, 'sensors sent', sent, 'suppressed', suppressed, 'suppression %.2f' % (suppressed / (sent + suppressed) if sent + suppressed else 0.0))
+        for node in nodes:
+                if isinstance(node, Sink):
+                        received = sum(counts[0] for counts in node.reporting.values())
+                        suppressed = sum(counts[1] for counts in node.reporting.values())
+                        err = sum(counts[2] for counts in node.reporting.values())
+                        # suppressed readings only become known with the next message
+                        print('sink', node.id, 'received', received, 'suppressed', suppressed, 'mean reconstruction error %.3f' % (err / (received + suppressed) if received + suppressed else 0.0), 'over suppressed %.3f' % (err / suppressed if suppressed else 0.0))
+
+
+def series_report(nodes):
+        for node in nodes:
+                if isinstance(node, Sink):
+                        for node_id in sorted(node.series):
+                                stats = node.window(node_id)
+                                hops = [reading[2] for reading in node.series[node_id].readings()]
+                                if stats['count']:
+                                        print('sink', node.id, 'node', node_id, 'count', stats['count'], 'min %.1f max %.1f mean %.2f' % (stats['min'], stats['max'], stats['mean']), 'hops', hops[-1])
+                        print('sink', node.id, 'series of', len(node.series), 'nodes,', sum(series.footprint() for series in node.series.values()), 'bytes')
+
+
+def publish_report(nodes):
+        for node in nodes:
+                if isinstance(node, Sink) and PUB_BATCH:
+                        stats = node.publisher.stats()
+                        print('sink', node.id, node.gw, 'readings', stats['readings'], 'coalesced', stats['coalesced'], 'messages', stats['messages'], 'bytes', stats['bytes'], 'readings per message %.1f' % stats['per_message'])
+        print('connections', len(pool.connections), 'threads', threading.active_count())
+        for connection in pool.connections:
+                name = 'connection ' + str(connection.index)
+                if hasattr(connection.client, 'stats'):
+                        stats = connection.client.stats()
+                        print(name, GW_TRANSPORT, 'sinks', len(connection.sinks), 'messages', stats['messages'], 'bytes', stats['bytes'], 'refused', stats['refused'], 'rate %.1f/s' % stats['rate'])
+                stats = connection.bridge.stats()
+                print(name, 'bridge enqueued', stats['enqueued'], 'published', stats['published'], 'failed', stats['failed'], 'dropped', stats['dropped'], 'depth', stats['depth'], 'mean depth %.1f max depth %d' % (stats['mean_depth'], stats['max_depth']), 'mean latency %.1f ms max latency %.1f ms' % (1000 * stats['mean_latency'], 1000 * stats['max_latency']))
+                if connection.bridge.journal is not None:
+                        stats = connection.bridge.journal.stats()
+                        print(name, 'journal pending', stats['pending'], 'bytes', stats['bytes'], 'appended', stats['appended'], 'replayed', stats['replayed'], 'replay rate %.1f/s' % stats['replay_rate'], 'commits', stats['commits'], 'commit cost %.2f ms' % (1000 * stats['commit_cost']))
+
+
+# Prints the reports every REPORT_INTERVAL while the gateway runs
+def report_p(env, nodes):
+        while True:
+                yield env.timeout(REPORT_INTERVAL)
+                print(env.now,': reports')
+                command_report(nodes)
+                reporting_report(nodes)
+                encoding_report(nodes)
+                series_report(nodes)
+                publish_report(nodes)
 
 
 # Start of main program
@@ -245,15 +1217,23 @@ env = simpy.rt.RealtimeEnvironment(factor=0.01, strict=False)
 # the communication medium
 media = Media(env)
 
+# recorded readings replayed by the sensors
+trace = Trace(SENSOR_SOURCE) if SENSOR_SOURCE else None
+
 # Nodes placed in a 2 dimensional space
 # Node(env, media, node_id, position_x, position_y)
-Sink(env,media,1,1,0)
-Sensor(env,media,2,0,1)
-Sensor(env,media,3,0,2)
-Sensor(env,media,4,0,3)
-Sensor(env,media,5,2,1)
-Sensor(env,media,6,2,2)
-Sensor(env,media,7,2,3)
+nodes = [
+Sink(env,media,1,1,0),
+#Sink(env,media,8,1,4,'Utz2'),
+Sensor(env,media,2,0,1),
+Sensor(env,media,3,0,2),
+Sensor(env,media,4,0,3),
+Sensor(env,media,5,2,1),
+Sensor(env,media,6,2,2),
+Sensor(env,media,7,2,3),
+]
+
+env.process(report_p(env, nodes))
 
 # Duration of the experiment
 # env.run(until=6000)
@@ -1,19 +1,272 @@
 # A simple wireless simulation environment
-from random import seed, randint
+from random import seed, randint, uniform, expovariate
+from collections import deque, OrderedDict
 from datetime import datetime
+from array import array
+import contextlib
+import heapq
 import json
 import math
+import mmap
+import os
+import struct
+import sys
 import simpy.rt
+try:
+	import numpy
+except ImportError:
+	numpy = None # load_events falls back to memoryviews
 
 RADIO_TXDISTANCE = 1.5  # transmissione range of nodes
 RADIO_LOSSRATE   = 10 # 10% packet loss rate
 RADIO_CHANNEL    = 99  # selected transmission channel
+RADIO_TXPOWER    = 1.0 # transmission power factor of nodes
+
+ENERGY_BATTERY      = 2000.0 # battery capacity of sensor nodes
+ENERGY_SINK_BATTERY = float('inf') # sinks are mains powered
+ENERGY_TX    = 0.06 # energy per time unit of transmission at transmission power 1
+ENERGY_RX    = 0.05 # energy per time unit of reception
+ENERGY_IDLE  = 0.05 # energy per time unit of idle listening, the radio draws about as much as receiving
+ENERGY_SENSE = 0.5  # energy per temperature reading
+
+MAC_DUTY_CYCLE    = False # duty cycled low power listening instead of always on radios
+MAC_WAKE_INTERVAL = 50 # time between two wake ups of a sleeping node
+MAC_WAKE_TIME     = 2  # time a node listens after waking up
+MAC_STROBE_GAP    = 1  # time between two strobes of a preamble, below MAC_WAKE_TIME
+
+MAC_CSMA          = True # transmit queue with carrier sense and random backoff
+MAC_QUEUE_SIZE    = 32   # frames waiting in the transmit queue of a node
+MAC_AIRTIME       = 0.1  # airtime of a frame, without its payload
+MAC_AIRTIME_BYTE  = 0.005 # airtime per payload byte
+MAC_BACKOFF_UNIT  = 0.2  # length of a backoff slot
+MAC_MIN_BE        = 2    # initial backoff exponent
+MAC_MAX_BE        = 5    # maximum backoff exponent
+MAC_MAX_BACKOFFS  = 5    # busy channel assessments before a frame is dropped
+
+ADVERT_TRICKLE    = True # adaptive Trickle advertising instead of fixed advert periods
+TRICKLE_IMIN      = 100  # minimum advertising interval
+TRICKLE_DOUBLINGS = 6    # the maximum interval is TRICKLE_IMIN * 2 ** TRICKLE_DOUBLINGS
+TRICKLE_K         = 2    # consistent adverts heard before our own advert is suppressed
+
+NBR_ALPHA          = 0.25 # weight of the latest advert in the link reception ratio
+NBR_MAX_ETX        = 10.0 # ETX of a link that lost all recent adverts
+NBR_HYSTERESIS     = 0.5  # path ETX improvement required to switch the parent
+NBR_TIMEOUT        = 3 * TRICKLE_IMIN * 2 ** TRICKLE_DOUBLINGS # neighbours not heard for this long are evicted, adverts at Imax are up to 1.5 Imax apart
+NBR_HOLD           = 5 * TRICKLE_IMIN # after losing the parent only closer nodes are joined for this long
+NBR_PARENT_TIMEOUT = 3 * 500 # a sensor parent not heard for three reading periods is taken for dead
+
+SINK_LOAD_WINDOW = 500  # period over which sinks measure the load of their neighbourhood
+SINK_LOAD_WEIGHT = 20.0 # path ETX a sink advertises for a fully busy neighbourhood
+SINK_LOAD_ALPHA  = 0.5  # weight of the latest window in the load of a sink
+
+DEDUP_SIZE   = 256  # (SRC, SEQ) pairs remembered by every node
+DEDUP_WINDOW = 2000 # time a pair is remembered at most
+
+SENSOR_SOURCE = None # trace file replayed by the sensors instead of random temperatures, see write_trace
+TRACE_LOOP    = True # start over at the end of a column, otherwise fall back to random temperatures
+TRACE_STRIDE  = 0    # readings between the starting points of neighbouring node ids in a shared column
+
+EVENTS       = None  # file prefix the radio events are recorded under, e.g. 'run' for run.time, run.node, ...
+EVENTS_CHUNK = 65536 # events kept in memory before they are appended to the files
+EVENT_COLUMNS = (('time', 'd'), ('node', 'i'), ('kind', 'b'), ('peer', 'i'), ('channel', 'i'), ('type', 'b'), ('seq', 'i'), ('hops', 'h'), ('reason', 'b'))
+EVENT_KINDS   = ('tx', 'rx', 'drop')
+EVENT_TYPES   = ('', 'JOIN', 'TEMP', 'AGGR', 'SOLICIT', 'ACK')
+EVENT_REASONS = ('', 'chan', 'self', 'range', 'dead', 'loss', 'dst', 'copy', 'cut')
+
+ROUTE_MAX_HOPS = 16 # hop limit of readings
+
+BENCHMARK     = False            # run the convergence benchmark instead of the scenario at the end
+BENCH_SIZES   = (9, 25, 49, 100) # nodes of the generated topologies, sinks included
+BENCH_FAILURE = 'relay'          # node that fails once the network formed: 'relay', 'sink' or None
+BENCH_FAIL_AT = 10000            # time of the failure
+BENCH_UNTIL   = BENCH_FAIL_AT + 2 * NBR_TIMEOUT # end of every run, a dead sink is only evicted after NBR_TIMEOUT
+BENCH_SAMPLE  = 10               # time between two looks at the ranks
+
+FAULTS         = False # apply FAULT_SCHEDULE and FAULT_CHURN to the scenario at the end
+FAULT_SCHEDULE = [     # (time, action, arguments...), node ids as arguments
+	(1500, 'kill', 2),              # node 2 fails
+	(2500, 'revive', 2),            # and comes back without its routing state
+	(3000, 'partition', [1, 2, 5]), # the listed groups only hear nodes of their own group
+	(3500, 'heal'),
+	(4000, 'link', 1, 5, 60),       # loss rate in % on the link between 1 and 5, both ways
+	(4500, 'link', 1, 5, None),     # back to RADIO_LOSSRATE
+	(5000, 'move', 1, 1, 1.5),      # the sink moves to (1|1.5)
+]
+FAULT_CHURN      = 0    # mean time between random sensor failures, 0 for none
+FAULT_CHURN_FROM = 2000 # time of the first random failure
+FAULT_DOWNTIME   = 800  # mean time a randomly failed sensor stays down
+FAULT_WINDOW     = 500  # period the readings delivered to the sinks are counted over
+
+HIST_UNIT = 0.01 # resolution of the latency histograms in time units
+HIST_BITS = 5    # the histograms keep 2**(HIST_BITS-1) buckets per power of two, about 6% wide
+
+AGG_ENABLED = False  # forwarders hold readings for a while and send them combined
+AGG_WINDOW  = 50     # time readings are held before they are sent
+AGG_MAX     = 16     # readings that are sent right away without waiting
+AGG_MODE    = 'list' # 'list' keeps every reading, 'summary' only min/max/avg/count
+
+LINK_ACK         = False # acknowledge unicast frames hop by hop and retransmit them
+LINK_ACK_TIMEOUT = 10 # time to wait for an acknowledgement after a frame was sent
+LINK_ACK_RETRIES = 3  # retransmissions before a frame is given up
+LINK_ACK_PENDING = 16 # unacknowledged frames a node keeps at most
 
 DEBUG_RADIO  = False #debug messages for the lowlevel radio True or False
 DEBUG_SENSOR = False #debug messages for the lowlevel sensors True or False
 DEBUG_ADVERT = True  #debug messages for the advertisement
 DEBUG_ROUTE  = False #general routing info 
 DEBUG_INFO   = False #general info messages 
+DEBUG_ENERGY = False #battery depletion messages
+DEBUG_MAC    = False #duty cycling messages
+DEBUG_FAULT  = True  #injected faults
+
+# A recorded trace of readings: 'TRC1', the number of columns, an index
+# of (node id, byte offset, length) and then one float32 column per
+# recorded node (little endian). The file is memory mapped and the columns
+# are views into it, so only the pages being read end up in memory
+class Trace(object):
+	def __init__(self, path):
+		self.file = open(path, 'rb')
+		self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+		if self.map[:4] != b'TRC1':
+			raise ValueError(path + ' is not a trace file')
+		count = struct.unpack_from('<I', self.map, 4)[0]
+		self.columns = OrderedDict()
+		for i in range(count):
+			node_id, offset, length = struct.unpack_from('<IQI', self.map, 8 + 16 * i)
+			self.columns[node_id] = memoryview(self.map)[offset:offset + 4 * length].cast('f')
+
+	def column(self, node_id):
+		# nodes that were not recorded get a column picked by their id
+		if node_id in self.columns:
+			return self.columns[node_id]
+		ids = list(self.columns)
+		return self.columns[ids[node_id % len(ids)]]
+
+def write_trace(path, columns):
+	# columns maps node ids to their readings
+	with open(path, 'wb') as file:
+		file.write(b'TRC1' + struct.pack('<I', len(columns)))
+		offset = 8 + 16 * len(columns)
+		for node_id, values in columns.items():
+			file.write(struct.pack('<IQI', node_id, offset, len(values)))
+			offset += 4 * len(values)
+		for values in columns.values():
+			column = array('f', values)
+			if sys.byteorder == 'big':
+				column.byteswap()
+			file.write(column.tobytes())
+
+# Replays the column of one node from a Trace, starting at an offset
+class Replay(object):
+	def __init__(self, trace, node_id, offset=0, loop=TRACE_LOOP):
+		self.values = trace.column(node_id)
+		self.pos = offset % len(self.values) if len(self.values) else 0
+		self.loop = loop
+
+	def next(self):
+		if self.pos >= len(self.values):
+			if not self.loop or not len(self.values):
+				return None
+			self.pos = 0
+		value = self.values[self.pos]
+		self.pos += 1
+		return value
+
+# Radio events kept in one array per column and appended to one raw file
+# per column (<prefix>.<column>) every EVENTS_CHUNK events. close() writes
+# <prefix>.json with the count and the codes, load_events() maps it back
+class Recorder(object):
+	def __init__(self, env, prefix):
+		self.env = env
+		self.prefix = prefix
+		self.count = 0
+		self.files = {}
+		self.columns = {}
+		for name, code in EVENT_COLUMNS:
+			self.files[name] = open(prefix + '.' + name, 'wb')
+			self.columns[name] = array(code)
+		self.headers = {} # msg_str -> (type, seq, hops), frames are seen by many receivers
+
+	def header(self, msg_str):
+		header = self.headers.get(msg_str)
+		if header is None:
+			if len(self.headers) > 1024:
+				self.headers.clear()
+			msg_json = json.loads(msg_str)
+			kind = EVENT_TYPES.index(msg_json['TYPE']) if msg_json['TYPE'] in EVENT_TYPES else 0
+			if 'HOPS' in msg_json:
+				hops = msg_json['HOPS']
+			elif 'TTL' in msg_json:
+				hops = ROUTE_MAX_HOPS - msg_json['TTL']
+			else:
+				hops = 0
+			header = (kind, msg_json.get('SEQ', 0), hops)
+			self.headers[msg_str] = header
+		return header
+
+	def record(self, node, kind, msg, reason=''):
+		# msg is the radio frame (sender, channel, src, ldst, msg_str, ...)
+		header = self.header(msg[4])
+		columns = self.columns
+		columns['time'].append(self.env.now)
+		columns['node'].append(node)
+		columns['kind'].append(EVENT_KINDS.index(kind))
+		columns['peer'].append(msg[2] if kind != 'tx' else msg[3])
+		columns['channel'].append(msg[1])
+		columns['type'].append(header[0])
+		columns['seq'].append(header[1])
+		columns['hops'].append(header[2])
+		columns['reason'].append(EVENT_REASONS.index(reason))
+		self.count += 1
+		if len(columns['time']) >= EVENTS_CHUNK:
+			self.flush()
+
+	def flush(self):
+		for name, code in EVENT_COLUMNS:
+			self.files[name].write(self.columns[name].tobytes())
+			self.columns[name] = array(code)
+
+	def close(self):
+		self.flush()
+		for file in self.files.values():
+			file.close()
+		meta = {'count': self.count, 'byteorder': sys.byteorder, 'columns': EVENT_COLUMNS, 'kinds': EVENT_KINDS, 'types': EVENT_TYPES, 'reasons': EVENT_REASONS}
+		with open(self.prefix + '.json', 'w') as file:
+			json.dump(meta, file)
+
+def load_events(prefix):
+	# the columns of a recorded run, memory mapped: numpy arrays when
+	# numpy is installed, memoryviews otherwise
+	with open(prefix + '.json') as file:
+		meta = json.load(file)
+	columns = {}
+	for name, code in meta['columns']:
+		path = prefix + '.' + name
+		if numpy is not None:
+			dtype = numpy.dtype(code).newbyteorder('<' if meta['byteorder'] == 'little' else '>')
+			columns[name] = numpy.memmap(path, dtype=dtype, mode='r') if meta['count'] else numpy.zeros(0, dtype)
+		elif meta['count']:
+			with open(path, 'rb') as file:
+				columns[name] = memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)).cast(code)
+		else:
+			columns[name] = array(code)
+	return meta, columns
+
+def events_report(prefix):
+	meta, columns = load_events(prefix)
+	print('events', meta['count'], 'bytes', sum(os.path.getsize(prefix + '.' + name) for name, code in meta['columns']))
+	if numpy is not None:
+		kinds = numpy.bincount(columns['kind'], minlength=len(meta['kinds']))
+		reasons = numpy.bincount(columns['reason'], minlength=len(meta['reasons']))
+	else:
+		kinds = [0] * len(meta['kinds'])
+		reasons = [0] * len(meta['reasons'])
+		for kind in columns['kind']:
+			kinds[kind] += 1
+		for reason in columns['reason']:
+			reasons[reason] += 1
+	print('  ' + ', '.join('%s %d' % (kind, kinds[i]) for i, kind in enumerate(meta['kinds'])))
+	print('  dropped: ' + ', '.join('%s %d' % (reason, reasons[i]) for i, reason in enumerate(meta['reasons']) if reason))
 
 # The media, the wireless channel to communicate
 class Media(object):
@@ -21,6 +274,7 @@ class Media(object):
 			self.env = env
 			self.capacity = capacity
 			self.pipes = []
+			self.active = [] # ongoing transmissions as (sender, end time)
 
 	def put(self, value):
 			if not self.pipes:
@@ -33,31 +287,608 @@ class Media(object):
 			self.pipes.append(pipe)
 			return pipe
 
+	def start(self, sender, airtime):
+			self.active.append((sender, self.env.now + airtime))
+
+	def busy(self, node):
+			# carrier sense, is anybody in range of node sending on its channel
+			now = self.env.now
+			self.active = [tx for tx in self.active if tx[1] > now]
+			for sender, end in self.active:
+					if sender is not node and sender.channel == node.channel:
+							if math.sqrt(((sender.posx - node.posx) ** 2) + ((sender.posy - node.posy) ** 2)) <= RADIO_TXDISTANCE:
+									return True
+			return False
+
+# The energy ledger, one slot per node in flat arrays so that the
+# accounting on the send/receive path is a couple of array updates
+class Energy(object):
+	def __init__(self, env, capacity=ENERGY_BATTERY):
+		self.env = env
+		self.capacity = capacity
+		self.nodes = []
+		self.battery = array('d')
+		self.used = array('d')
+		self.tx = array('d')
+		self.rx = array('d')
+		self.idle = array('d')
+		self.sense = array('d')
+		self.since = array('d') # start of the idle listening not accounted yet
+		self.listening = array('b') # 1 while the radio of the node is on
+		self.depleted = array('d') # time of depletion, -1 while alive
+
+	def register(self, node, capacity=None):
+		if capacity is None:
+			capacity = self.capacity
+		self.nodes.append(node)
+		self.battery.append(capacity)
+		for column in (self.used, self.tx, self.rx, self.idle, self.sense):
+			column.append(0.0)
+		self.since.append(self.env.now)
+		self.listening.append(1)
+		self.depleted.append(-1.0)
+		return len(self.nodes) - 1
+
+	def charge(self, idx, column, amount):
+		column[idx] += amount
+		self.used[idx] += amount
+		if self.used[idx] >= self.battery[idx] and self.depleted[idx] < 0:
+			self.depleted[idx] = self.env.now
+			self.nodes[idx].deplete()
+
+	def airtime(self, idx, column, airtime, power):
+		# a frame costs the power of the radio over its airtime, on the
+		# same time base as idle listening. While the radio was on that
+		# airtime was accounted as idle already, it is moved over
+		self.listen(idx)
+		if self.listening[idx]:
+			refund = min(airtime * ENERGY_IDLE, self.idle[idx])
+			self.idle[idx] -= refund
+			self.used[idx] -= refund
+		self.charge(idx, column, airtime * power)
+
+	def listen(self, idx):
+		# account the idle listening since the last update of this node
+		now = self.env.now
+		if self.listening[idx] and self.depleted[idx] < 0 and now > self.since[idx]:
+			amount = (now - self.since[idx]) * ENERGY_IDLE
+			self.since[idx] = now
+			self.charge(idx, self.idle, amount)
+
+	def radio(self, idx, on):
+		self.listen(idx)
+		self.listening[idx] = on
+		self.since[idx] = self.env.now
+
+	def recharge(self, idx):
+		# a revived node starts over with a full battery, whether it
+		# failed with an empty one or was killed
+		self.listen(idx)
+		capacity = self.nodes[idx].battery_capacity()
+		self.battery[idx] = self.used[idx] + (self.capacity if capacity is None else capacity)
+		self.depleted[idx] = -1.0
+		self.since[idx] = self.env.now
+
+	def settle(self):
+		for idx in range(len(self.nodes)):
+			self.listen(idx)
+
+	def remaining(self, idx):
+		return max(self.battery[idx] - self.used[idx], 0.0)
+
+	def report(self):
+		self.settle()
+		print(self.env.now,': energy report')
+		for idx, node in enumerate(self.nodes):
+			print('  node', node.id, 'tx %.1f rx %.1f idle %.1f sense %.1f used %.1f remaining %.1f' % (self.tx[idx], self.rx[idx], self.idle[idx], self.sense[idx], self.used[idx], self.remaining(idx)), end='')
+			if self.depleted[idx] >= 0:
+				print(' depleted at', self.depleted[idx])
+			else:
+				print()
+
+# Log-linear histogram in the style of HdrHistogram. Values are counted
+# in units of HIST_UNIT, exactly below 2**HIST_BITS units and above that in
+# 2**(HIST_BITS-1) buckets per power of two, so memory grows with the
+# logarithm of the largest value while percentiles stay within a bucket
+class Histogram(object):
+	def __init__(self, unit=HIST_UNIT, bits=HIST_BITS):
+		self.unit = unit
+		self.bits = bits
+		self.counts = array('L')
+		self.count = 0
+		self.total = 0.0
+		self.min = None
+		self.max = None
+
+	def index(self, n):
+		if n < (1 << self.bits):
+			return n
+		shift = n.bit_length() - self.bits
+		return (1 << self.bits) + (shift - 1) * (1 << (self.bits - 1)) + (n >> shift) - (1 << (self.bits - 1))
+
+	def upper(self, index):
+		# the largest value, in units, counted in a bucket
+		if index < (1 << self.bits):
+			return index
+		half = 1 << (self.bits - 1)
+		shift = (index - (1 << self.bits)) // half + 1
+		top = (index - (1 << self.bits)) % half + half
+		return ((top + 1) << shift) - 1
+
+	def record(self, value):
+		index = self.index(int(value / self.unit))
+		if index >= len(self.counts):
+			self.counts.extend([0] * (index + 1 - len(self.counts)))
+		self.counts[index] += 1
+		self.count += 1
+		self.total += value
+		self.min = value if self.min is None else min(self.min, value)
+		self.max = value if self.max is None else max(self.max, value)
+
+	def percentile(self, p):
+		if not self.count:
+			return None
+		target = max(1, math.ceil(p / 100.0 * self.count))
+		seen = 0
+		for index, count in enumerate(self.counts):
+			seen += count
+			if seen >= target:
+				return min((self.upper(index) + 1) * self.unit, self.max)
+		return self.max
+
+	def stats(self):
+		return {'count': self.count, 'mean': self.total / self.count if self.count else None, 'min': self.min, 'max': self.max, 'p50': self.percentile(50), 'p90': self.percentile(90), 'p99': self.percentile(99)}
+
+# Recently seen (SRC, SEQ) pairs, bounded in size (least recently seen
+# pairs go first) and in time
+class Seen(object):
+	def __init__(self, env, size=DEDUP_SIZE, window=DEDUP_WINDOW):
+		self.env = env
+		self.size = size
+		self.window = window
+		self.entries = OrderedDict()
+		self.hits = 0
+		self.misses = 0
+
+	def check(self, src, seq):
+		# True if the pair was seen before, otherwise remember it
+		key = (src, seq)
+		now = self.env.now
+		seen = self.entries.get(key)
+		if seen is not None and now - seen <= self.window:
+			self.hits += 1
+			self.entries.move_to_end(key)
+			return True
+		self.misses += 1
+		self.entries[key] = now
+		self.entries.move_to_end(key)
+		if len(self.entries) > self.size:
+			self.entries.popitem(last=False)
+		return False
+
+	def footprint(self):
+		# approximate memory used by the cache in bytes
+		return sys.getsizeof(self.entries) + sum(sys.getsizeof(key) + sys.getsizeof(key[0]) + sys.getsizeof(key[1]) for key in self.entries)
+
+	def stats(self):
+		checks = self.hits + self.misses
+		return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / checks if checks else 0.0, 'entries': len(self.entries), 'bytes': self.footprint()}
+
 # A node, providing basic sensing and communication API
 class Node(object):
-	def __init__(self, env, media, id, posx, posy):
+	frames = 0 # identifiers of strobed frames
+
+	def __init__(self, env, media, id, posx, posy, energy=None):
 		self.env = env
 		self.media_in = media.get_output_conn()
 		self.media_out = media
 		self.channel = RADIO_CHANNEL
+		self.transmission_power = RADIO_TXPOWER
 		self.id = id
 		self.posx = posx
 		self.posy = posy
 		self.sqnr = 0
 		self.rank = 0
-		env.process(self.main_p())
-		env.process(self.receive_p())
+		self.alive = True
+		self.energy = energy
+		if energy:
+			self.eidx = energy.register(self, self.battery_capacity())
+		self.awake = True
+		self.mac_seen = {}
+		self.mac_wakeups = 0
+		self.mac_strobes = 0
+		self.mac_frames = 0
+		self.mac_delivered = 0
+		self.mac_delay = 0
+		self.txq = deque()
+		self.txq_wakeup = None
+		self.txq_max = 0
+		self.txq_area = 0 # integral of the queue length over time
+		self.txq_since = env.now
+		self.txq_sent = 0
+		self.txq_dropped = 0
+		self.backoffs = 0
+		self.backoff_time = 0
+		self.trickle_i = TRICKLE_IMIN
+		self.trickle_c = 0
+		self.trickle_event = None
+		self.ctrl_sent = 0
+		self.data_sent = 0
+		self.joined_at = None
+		self.rank_changed_at = None
+		self.aseq = 0
+		self.path_etx = 0.0
+		self.root = 0
+		self.rx_airtime = 0
+		self.neighbours = {}
+		self.seen = Seen(env)
+		self.source = None
+		self.loops = 0
+		self.ttl_expired = 0
+		self.agg_read = []
+		self.agg_sum = None
+		self.agg_held = [] # arrival time and number of readings held
+		self.agg_ttl = ROUTE_MAX_HOPS
+		self.agg_timer = False
+		self.agg_readings = 0
+		self.agg_messages = 0
+		self.agg_hold = 0
+		self.lseq = 0
+		self.pending = {} # link sequence number -> [ldst, msg_str, retransmissions, sent event]
+		self.tx_done = {} # frames somebody waits for -> event
+		self.ack_frames = 0
+		self.ack_ok = 0
+		self.ack_failed = 0
+		self.ack_overflow = 0
+		self.ack_sent = 0
+		self.retransmissions = 0
+		self.failures = 0
+		self.boots = 0 # revivals, a transmit process of an earlier boot stops
+		self.procs = {} # name -> process, see revive
+		self.procs['main'] = env.process(self.main_p())
+		self.procs['receive'] = env.process(self.receive_p())
+		if MAC_DUTY_CYCLE and self.duty_cycled():
+			self.sleep()
+			self.procs['mac'] = env.process(self.mac_p())
+		if MAC_CSMA:
+			self.procs['tx'] = env.process(self.tx_p())
+
+	def battery_capacity(self):
+		return None
+
+	def duty_cycled(self):
+		return True
+
+	def sleep(self):
+		# a sleeping node is detached from the media, frames sent
+		# meanwhile never reach its store and never wake its process
+		self.awake = False
+		if self.media_in in self.media_out.pipes:
+			self.media_out.pipes.remove(self.media_in)
+		if self.energy:
+			self.energy.radio(self.eidx, 0)
+
+	def wake(self):
+		self.awake = True
+		self.mac_wakeups += 1
+		if self.media_in not in self.media_out.pipes:
+			self.media_out.pipes.append(self.media_in)
+		if self.energy:
+			self.energy.radio(self.eidx, 1)
+
+	def mac_p(self):
+		# wake up periodically with a random phase to check the channel
+		yield self.env.timeout(randint(0, MAC_WAKE_INTERVAL - 1))
+		while self.alive:
+			self.wake()
+			yield self.env.timeout(MAC_WAKE_TIME)
+			if not self.alive:
+				return
+			self.sleep()
+			yield self.env.timeout(MAC_WAKE_INTERVAL - MAC_WAKE_TIME)
+
+	def strobe_p(self, msg):
+		# strobed preamble, the frame is repeated until the destination
+		# woke up and received it, broadcasts are repeated for a whole
+		# wake interval so that every neighbour hears them once
+		Node.frames += 1
+		frame = [Node.frames, False]
+		sent, msg = msg, msg + (frame,)
+		start = self.env.now
+		end = start + MAC_WAKE_INTERVAL + MAC_WAKE_TIME
+		self.mac_frames += 1
+		while self.alive and not frame[1] and self.env.now < end:
+			if MAC_CSMA:
+				yield from self.airtime_p(msg)
+			else:
+				self.transmit(msg)
+			self.mac_strobes += 1
+			yield self.env.timeout(MAC_STROBE_GAP)
+		if frame[1]:
+			self.mac_delivered += 1
+			self.mac_delay += self.env.now - start
+		self.frame_done(sent, frame[1])
+		if (DEBUG_MAC):
+			print(self.env.now,':', self.id,'strobed frame', frame[0], 'to', msg[3], 'delivered' if frame[1] else 'not delivered')
+
+	def advert(self):
+		# send a join message to all around me
+		self.sqnr += 1
+		msg_json = {}
+		msg_json['TYPE'] = 'JOIN'
+		msg_json['SRC']  = self.id
+		msg_json['DST']  = 0
+		msg_json['LSRC'] = self.id
+		msg_json['LDST'] = 0
+		msg_json['RNK'] = self.rank
+		msg_json['SEQ']  = self.sqnr
+		self.aseq += 1
+		msg_json['ASEQ'] = self.aseq
+		msg_json['ETX']  = round(self.path_etx, 2)
+		msg_json['ROOT'] = self.root
+		msg_str = json.dumps( msg_json )
+		if (DEBUG_ADVERT):
+			print(self.env.now,':', self.id ,'sending advert' , msg_str)
+		self.ctrl_sent += 1
+		self.send(msg_json['LDST'],msg_str)
+
+	def trickle_p(self):
+		# Trickle timer (RFC 6206), the advert interval doubles up to
+		# its maximum while everything we hear is consistent and our
+		# own advert is suppressed once TRICKLE_K others were heard
+		imax = TRICKLE_IMIN * 2 ** TRICKLE_DOUBLINGS
+		while self.alive:
+			start = self.env.now
+			self.trickle_c = 0
+			self.trickle_event = self.env.event()
+			yield self.env.timeout(uniform(self.trickle_i / 2, self.trickle_i)) | self.trickle_event
+			if not self.trickle_event.triggered:
+				if self.rank > 0 and self.trickle_c < TRICKLE_K and self.alive:
+					self.advert()
+				# the interval may have been shortened meanwhile by a revive
+				yield self.env.timeout(max(start + self.trickle_i - self.env.now, 0)) | self.trickle_event
+			if self.trickle_event.triggered:
+				self.trickle_i = TRICKLE_IMIN
+			else:
+				self.trickle_i = min(self.trickle_i * 2, imax)
+
+	def trickle_consistent(self):
+		self.trickle_c += 1
+
+	def trickle_reset(self):
+		# an inconsistency was heard, advertise quickly again
+		if self.trickle_i > TRICKLE_IMIN and self.trickle_event and not self.trickle_event.triggered:
+			self.trickle_event.succeed()
+
+	def rank_changed(self):
+		if self.joined_at is None:
+			self.joined_at = self.env.now
+		self.rank_changed_at = self.env.now
+		if ADVERT_TRICKLE:
+			self.trickle_reset()
+
+	def deplete(self):
+		# a node with an empty battery leaves the network, it is not
+		# served by the media anymore and its processes stop
+		if (DEBUG_ENERGY):
+			print(self.env.now,':', self.id,'battery depleted')
+		self.alive = False
+		if self.media_in in self.media_out.pipes:
+			self.media_out.pipes.remove(self.media_in)
+
+	def revive(self):
+		# a failed node reboots: frames queued or waiting for an
+		# acknowledgement before the failure are lost, the processes
+		# that ended while it was down start again, the ones still
+		# waiting carry on
+		self.alive = True
+		self.boots += 1
+		self.trickle_i = TRICKLE_IMIN
+		self.neighbours = {}
+		self.queue_changed()
+		self.txq.clear()
+		self.pending = {}
+		for done in self.tx_done.values():
+			done.succeed(False)
+		self.tx_done = {}
+		if self.txq_wakeup and not self.txq_wakeup.triggered:
+			self.txq_wakeup.succeed()
+		if self.energy:
+			self.energy.recharge(self.eidx)
+		if MAC_DUTY_CYCLE and self.duty_cycled():
+			self.sleep()
+		else:
+			self.awake = True
+			if self.media_in not in self.media_out.pipes:
+				self.media_out.pipes.append(self.media_in)
+			if self.energy:
+				self.energy.radio(self.eidx, 1)
+		for name, proc in list(self.procs.items()):
+			# the transmit process of the last boot stops by itself
+			if not proc.is_alive or name == 'tx':
+				self.procs[name] = self.env.process(getattr(self, name + '_p')())
 
 	def temperature(self):
-		temp = randint(27, 35)
+		temp = self.source.next() if self.source else None
+		if temp is None:
+			temp = randint(27, 35)
+		else:
+			temp = int(round(temp)) # whole degrees, like the micro:bit
+		if self.energy:
+			self.energy.charge(self.eidx, self.energy.sense, ENERGY_SENSE)
 		if (DEBUG_SENSOR):
 			print(self.env.now,':', self.id,'sensing temperature of', temp)
 		return temp
 
 	def send(self, ldst, msg_str):
+		if not self.alive:
+			return
+		if LINK_ACK and ldst != 0:
+			if len(self.pending) >= LINK_ACK_PENDING:
+				self.ack_overflow += 1
+				if (DEBUG_RADIO):
+					print(self.env.now,':', self.id,'X (pending full)', ldst)
+				return
+			msg_json = json.loads(msg_str)
+			self.lseq += 1
+			msg_json['LSEQ'] = self.lseq
+			msg_str = json.dumps( msg_json )
+			sent = self.env.event()
+			self.pending[self.lseq] = [ldst, msg_str, 0, sent]
+			self.ack_frames += 1
+			self.env.process(self.ack_p(self.lseq))
+			self.radio_send(ldst, msg_str, sent)
+		else:
+			self.radio_send(ldst, msg_str)
+
+	def ack_p(self, lseq):
+		# retransmit the frame until it is acknowledged or given up, the
+		# timeout starts once the frame actually left the radio
+		while True:
+			entry = self.pending.get(lseq)
+			delivered = yield entry[3]
+			if delivered and lseq in self.pending:
+				# the strobed preamble was answered by the destination
+				del self.pending[lseq]
+				self.ack_ok += 1
+				return
+			yield self.env.timeout(LINK_ACK_TIMEOUT)
+			entry = self.pending.get(lseq)
+			if entry is None or not self.alive:
+				return
+			if entry[2] >= LINK_ACK_RETRIES:
+				del self.pending[lseq]
+				self.ack_failed += 1
+				if (DEBUG_RADIO):
+					print(self.env.now,':', self.id,'X (no ack)', entry[0])
+				self.link_failed(entry[0])
+				return
+			entry[2] += 1
+			entry[3] = self.env.event()
+			self.retransmissions += 1
+			self.radio_send(entry[0], entry[1], entry[3])
+
+	def frame_done(self, msg, delivered):
+		done = self.tx_done.pop(id(msg), None)
+		if done is not None:
+			done.succeed(delivered)
+
+	def link_receive(self, msg_json):
+		# handle acknowledgements and acknowledge frames sent to us,
+		# returns whether the frame is for the upper layers
+		if msg_json['TYPE'] == 'ACK':
+			if msg_json['LDST'] == self.id and self.pending.pop(msg_json['LSEQ'], None) is not None:
+				self.ack_ok += 1
+			return False
+		if 'LSEQ' in msg_json and msg_json['LDST'] == self.id and not MAC_DUTY_CYCLE:
+			# when duty cycling the strobed preamble acknowledges frames
+			ack_json = {}
+			ack_json['TYPE'] = 'ACK'
+			ack_json['LSRC'] = self.id
+			ack_json['LDST'] = msg_json['LSRC']
+			ack_json['LSEQ'] = msg_json['LSEQ']
+			ack = (self, self.channel, self.id, ack_json['LDST'], json.dumps( ack_json ))
+			self.ack_sent += 1
+			if MAC_CSMA:
+				# acknowledgements are sent right away, without carrier sense
+				self.env.process(self.airtime_p(ack))
+			else:
+				self.transmit(ack)
+		return True
+
+	def link_failed(self, ldst):
+		pass
+
+	def radio_send(self, ldst, msg_str, done=None):
 		if (DEBUG_RADIO):
 			print(self.env.now,':', self.id,'->', ldst)
 		msg = (self, self.channel, self.id, ldst, str(msg_str))
+		if done is not None:
+			self.tx_done[id(msg)] = done
+		if MAC_CSMA:
+			self.enqueue(msg)
+		elif MAC_DUTY_CYCLE:
+			self.env.process(self.strobe_p(msg))
+		else:
+			self.transmit(msg)
+			self.frame_done(msg, None)
+
+	def queue_changed(self):
+		now = self.env.now
+		self.txq_area += len(self.txq) * (now - self.txq_since)
+		self.txq_since = now
+
+	def enqueue(self, msg):
+		if len(self.txq) >= MAC_QUEUE_SIZE:
+			self.txq_dropped += 1
+			if (DEBUG_MAC):
+				print(self.env.now,':', self.id,'X (queue full)', msg[3])
+			self.frame_done(msg, False)
+			return
+		self.queue_changed()
+		self.txq.append(msg)
+		self.txq_max = max(self.txq_max, len(self.txq))
+		if self.txq_wakeup and not self.txq_wakeup.triggered:
+			self.txq_wakeup.succeed()
+
+	def tx_p(self):
+		# serve the transmit queue with unslotted CSMA/CA: a random
+		# backoff before every channel assessment, the backoff
+		# window doubles while the channel is busy
+		boot = self.boots
+		while self.alive and self.boots == boot:
+			if not self.txq:
+				self.txq_wakeup = self.env.event()
+				yield self.txq_wakeup
+				continue
+			msg = self.txq[0]
+			be = MAC_MIN_BE
+			for attempt in range(MAC_MAX_BACKOFFS):
+				backoff = randint(0, 2 ** be - 1) * MAC_BACKOFF_UNIT
+				self.backoffs += 1
+				self.backoff_time += backoff
+				yield self.env.timeout(backoff)
+				if self.boots != boot:
+					return
+				if not self.media_out.busy(self):
+					break
+				be = min(be + 1, MAC_MAX_BE)
+			else:
+				self.queue_changed()
+				self.txq.popleft()
+				self.txq_dropped += 1
+				if (DEBUG_MAC):
+					print(self.env.now,':', self.id,'X (channel busy)', msg[3])
+				self.frame_done(msg, False)
+				continue
+			if MAC_DUTY_CYCLE:
+				yield from self.strobe_p(msg)
+			else:
+				yield from self.airtime_p(msg)
+			if self.boots != boot:
+				return
+			if not MAC_DUTY_CYCLE:
+				self.frame_done(msg, None)
+			self.queue_changed()
+			self.txq.popleft()
+			self.txq_sent += 1
+
+	def airtime(self, msg):
+		return MAC_AIRTIME + len(msg[4]) * MAC_AIRTIME_BYTE
+
+	def airtime_p(self, msg):
+		# the frame occupies the channel and arrives once it is complete
+		airtime = self.airtime(msg)
+		self.media_out.start(self, airtime)
+		yield self.env.timeout(airtime)
+		if self.alive:
+			self.transmit(msg)
+
+	def transmit(self, msg):
+		if self.energy:
+			self.energy.airtime(self.eidx, self.energy.tx, self.airtime(msg), ENERGY_TX * self.transmission_power)
+		if recorder:
+			recorder.record(self.id, 'tx', msg)
 		self.media_out.put(msg)
 
 	def receive(self, msg):
@@ -65,54 +896,177 @@ class Node(object):
 		if (msg[1] != self.channel) :
 			if (DEBUG_RADIO):
 				print(self.env.now,':', self.id,'X (chan)', msg[2], 'distance', distance)
+			if recorder:
+				recorder.record(self.id, 'drop', msg, 'chan')
 			return None
 		elif (msg[2] == self.id) :
 			if (DEBUG_RADIO):
 				print(self.env.now,':', self.id,'X (self)', msg[2], 'distance', distance)
+			if recorder:
+				recorder.record(self.id, 'drop', msg, 'self')
 			return None
 		elif (distance > RADIO_TXDISTANCE) :
 			if (DEBUG_RADIO):
 				print(self.env.now,':', self.id,'X (range)', msg[2], 'distance', distance)
+			if recorder:
+				recorder.record(self.id, 'drop', msg, 'range')
+			return None
+		elif faults and faults.cut(msg[2], self.id) :
+			if (DEBUG_RADIO):
+				print(self.env.now,':', self.id,'X (cut)', msg[2], 'distance', distance)
+			if recorder:
+				recorder.record(self.id, 'drop', msg, 'cut')
 			return None
-		elif (randint(0,100) < RADIO_LOSSRATE) :
+		self.rx_airtime += self.airtime(msg)
+		if self.energy:
+			# the frame is on our channel and in range, the radio receives it
+			self.energy.airtime(self.eidx, self.energy.rx, self.airtime(msg), ENERGY_RX)
+			if not self.alive:
+				if recorder:
+					recorder.record(self.id, 'drop', msg, 'dead')
+				return None
+		if (randint(0,100) < (faults.loss(msg[2], self.id) if faults else RADIO_LOSSRATE)) :
 			if (DEBUG_RADIO):
 				print(self.env.now,':', self.id,'X (loss)', msg[2], 'distance', distance)
+			if recorder:
+				recorder.record(self.id, 'drop', msg, 'loss')
 			return None
 		else:
+			if msg[2] in self.neighbours:
+				# overheard frames keep the neighbour alive as well
+				self.neighbours[msg[2]].last_heard = self.env.now
 			if ((msg[3] == 0) or (msg[3] == self.id)) :
+				if len(msg) > 5:
+					# strobed frame, only the first copy is delivered
+					frame = msg[5]
+					if frame[0] in self.mac_seen:
+						if recorder:
+							recorder.record(self.id, 'drop', msg, 'copy')
+						return None
+					if len(self.mac_seen) > 64:
+						self.mac_seen = {fid: t for fid, t in self.mac_seen.items() if t > self.env.now - 2 * MAC_WAKE_INTERVAL}
+					self.mac_seen[frame[0]] = self.env.now
+					if msg[3] == self.id:
+						frame[1] = True
 				if (DEBUG_RADIO):
 					print(self.env.now,':', self.id,'<-', msg[2], 'distance', distance)
+				if recorder:
+					recorder.record(self.id, 'rx', msg)
 				return(str(msg[4]))
 			if (DEBUG_RADIO):
 				print(self.env.now,':', self.id,'X (dst)', msg[2], 'distance', distance)
+			if recorder:
+				recorder.record(self.id, 'drop', msg, 'dst')
 			return None
 
 
+# An entry of the neighbour table, the link quality is estimated from
+# the reception ratio of the adverts of the neighbour
+class Neighbour(object):
+	def __init__(self, id, now):
+		self.id = id
+		self.rank = 0
+		self.path_etx = 0.0
+		self.root = 0
+		self.prr = 1.0
+		self.aseq = None
+		self.last_heard = now
+
+	def advert(self, msg_json, now):
+		if self.aseq is not None and msg_json['ASEQ'] > self.aseq:
+			# every advert missed in between is a failed reception
+			missed = msg_json['ASEQ'] - self.aseq - 1
+			self.prr *= (1 - NBR_ALPHA) ** missed
+			self.prr = (1 - NBR_ALPHA) * self.prr + NBR_ALPHA
+		self.aseq = msg_json['ASEQ']
+		self.rank = msg_json['RNK']
+		self.path_etx = msg_json['ETX']
+		self.root = msg_json['ROOT']
+		self.last_heard = now
+
+	def etx(self):
+		return min(1.0 / self.prr, NBR_MAX_ETX) if self.prr > 0 else NBR_MAX_ETX
+
+	def metric(self):
+		# path ETX to the sink through this neighbour
+		return self.path_etx + self.etx()
+
 # A sink node
 class Sink(Node):
-	def __init__(self, env, media, id, posx, posy):
-		super().__init__(env, media, id, posx, posy)
+	def __init__(self, env, media, id, posx, posy, energy=None):
+		super().__init__(env, media, id, posx, posy, energy)
 		self.channel = RADIO_CHANNEL 
 		self.rank = 1
+		self.root = self.id
+		self.load = 0.0
+		self.received = 0
+		self.data_frames = 0
+		self.latency = Histogram()
+		self.source_latency = {} # source -> Histogram
+		self.rank_latency = {}   # rank of the source when it sent the reading -> Histogram
+		self.source_hops = {}    # source -> [hops, readings]
 		print(self.env.now,':', self.id,'new sink node (', self.posx,'|', self.posy,')')
+		self.procs['load'] = env.process(self.load_p())
+
+	def battery_capacity(self):
+		return ENERGY_SINK_BATTERY
+
+	def delivered(self, src, origin, hops, rank):
+		latency = self.env.now - origin
+		self.latency.record(latency)
+		if src not in self.source_latency:
+			self.source_latency[src] = Histogram()
+			self.source_hops[src] = [0, 0]
+		self.source_latency[src].record(latency)
+		self.source_hops[src][0] += hops
+		self.source_hops[src][1] += 1
+		if rank not in self.rank_latency:
+			self.rank_latency[rank] = Histogram()
+		self.rank_latency[rank].record(latency)
+
+	def metrics(self):
+		# latency percentiles overall, per source and per rank, and mean hops per source
+		return {'latency': self.latency.stats(),
+			'source': {src: histogram.stats() for src, histogram in self.source_latency.items()},
+			'rank': {rank: histogram.stats() for rank, histogram in self.rank_latency.items()},
+			'hops': {src: hops / count for src, (hops, count) in self.source_hops.items()}}
+
+	def duty_cycled(self):
+		# sinks are mains powered and keep their radio on
+		return False
+
+	def trickle_consistent(self):
+		# a sink is only heard through its adverts, it never suppresses
+		# them so that its children do not evict it after NBR_TIMEOUT
+		pass
+
+	def load_p(self):
+		# the share of time the channel around the sink is busy is
+		# advertised as path ETX, so that sensors between two sinks
+		# move to the less congested one
+		last = 0
+		while self.alive:
+			yield self.env.timeout(SINK_LOAD_WINDOW)
+			busy = min((self.rx_airtime - last) / SINK_LOAD_WINDOW, 1.0)
+			last = self.rx_airtime
+			self.load = (1 - SINK_LOAD_ALPHA) * self.load + SINK_LOAD_ALPHA * busy
+			penalty = SINK_LOAD_WEIGHT * self.load
+			if abs(penalty - self.path_etx) >= NBR_HYSTERESIS:
+				if (DEBUG_ADVERT):
+					print(self.env.now,':', self.id ,'sink load %.3f' % self.load, 'etx: %.2f' % penalty)
+				self.path_etx = penalty
+				if ADVERT_TRICKLE:
+					self.trickle_reset()
+			else:
+				self.path_etx = penalty
 
 	def main_p(self):
-		while True:
+		if ADVERT_TRICKLE:
+			yield from self.trickle_p()
+		while self.alive:
 			yield self.env.timeout(100)
 			# send a broadcast advert message
-			self.sqnr += 1
-			msg_json = {}
-			msg_json['TYPE'] = 'JOIN'
-			msg_json['SRC']  = self.id
-			msg_json['DST']  = 0
-			msg_json['LSRC'] = self.id
-			msg_json['LDST'] = 0
-			msg_json['RNK'] = self.rank
-			msg_json['SEQ']  = self.sqnr
-			msg_str = json.dumps( msg_json )
-			if (DEBUG_ADVERT):
-				print(self.env.now,':', self.id ,'sending advert' , msg_str)
-			self.send(msg_json['LDST'],msg_str)
+			self.advert()
 
 
 	def receive_p(self):
@@ -123,52 +1077,288 @@ class Sink(Node):
 				if (DEBUG_INFO):
 					print(self.env.now,':', self.id ,'sink, receiving' , msg_str)
 				msg_json = json.loads(msg_str)
-				if msg_json['TYPE'] == 'TEMP':
-					print(self.env.now,':', self.id ,'sensor',msg_json['SRC'],'reports', msg_json['DATA'])
+				if not self.link_receive(msg_json):
+					continue
+				if msg_json['TYPE'] == 'TEMP' or msg_json['TYPE'] == 'AGGR':
+					if self.seen.check(msg_json['SRC'], msg_json['SEQ']):
+						if (DEBUG_ROUTE):
+							print(self.env.now,':', self.id ,'dropping duplicate' , msg_str)
+						continue
+					# any sink accepts readings, whatever sink they were sent to
+					self.data_frames += 1
+					if msg_json['TYPE'] == 'TEMP':
+						self.received += 1
+						self.delivered(msg_json['SRC'], msg_json['OT'], msg_json['HOPS'] + 1, msg_json['ORNK'])
+						print(self.env.now,':', self.id ,'sensor',msg_json['SRC'],'reports', msg_json['DATA'])
+					elif 'SUM' in msg_json:
+						low, high, total, count = msg_json['SUM']
+						self.received += count
+						print(self.env.now,':', self.id ,'sensors via',msg_json['SRC'],'report min', low, 'max', high, 'avg %.1f' % (total / count), 'count', count)
+					else:
+						for src, seq, data, origin, hops, rank in msg_json['READ']:
+							if not self.seen.check(src, seq):
+								self.received += 1
+								self.delivered(src, origin, hops + msg_json['HOPS'] + 1, rank)
+								print(self.env.now,':', self.id ,'sensor',src,'reports', data)
+				elif msg_json['TYPE'] == 'JOIN':
+					self.trickle_consistent()
+				elif msg_json['TYPE'] == 'SOLICIT':
+					self.trickle_reset()
 
 # A sensor node
 class Sensor(Node):
-	def __init__(self, env, media, id, posx, posy):
-		super().__init__(env, media, id, posx, posy)
+	def __init__(self, env, media, id, posx, posy, energy=None):
+		super().__init__(env, media, id, posx, posy, energy)
 		self.join_node = 0
+		self.hold_rank = 0
+		self.hold_until = 0
+		if trace:
+			self.source = Replay(trace, self.id, self.id * TRACE_STRIDE)
 		print(self.env.now,':', self.id,'new sensor node (', self.posx,'|', self.posy,')')
+		if ADVERT_TRICKLE:
+			self.procs['trickle'] = env.process(self.trickle_p())
+
+	def revive(self):
+		# the parent and rank are not kept over a reboot
+		self.join_node = 0
+		self.rank = 0
+		self.root = 0
+		self.path_etx = 0.0
+		self.hold_rank = 0
+		self.hold_until = 0
+		super().revive()
 
 	def main_p(self):
 		while True:
 			yield self.env.timeout(randint(300, 500))
+			if not self.alive:
+				return
+			self.evict()
 			if self.join_node == 0:
 				print(self.env.now,':', self.id ,'cannot send messages, not joined a topology yet')
+				if ADVERT_TRICKLE:
+					self.solicit()
 			else:
 				# send a temperature message to the sink 
 				self.sqnr += 1
 				msg_json = {}
 				msg_json['TYPE'] = 'TEMP'
 				msg_json['SRC']  = self.id
-				msg_json['DST']  = 1 
+				msg_json['DST']  = self.root
 				msg_json['LSRC'] = self.id
 				msg_json['LDST'] = self.join_node
 				msg_json['SEQ']  = self.sqnr
+				msg_json['TTL']  = ROUTE_MAX_HOPS
+				msg_json['LRNK'] = self.rank
+				msg_json['OT']   = self.env.now
+				msg_json['HOPS'] = 0
+				msg_json['ORNK'] = self.rank
 				msg_json['DATA'] = self.temperature()
-				msg_str = json.dumps( msg_json )
-				if (DEBUG_INFO):
-					print(self.env.now,':', self.id ,'sending sensor reading' , msg_str)
-				self.send(msg_json['LDST'],msg_str)
+				if AGG_ENABLED:
+					self.aggregate(msg_json)
+				else:
+					msg_str = json.dumps( msg_json )
+					if (DEBUG_INFO):
+						print(self.env.now,':', self.id ,'sending sensor reading' , msg_str)
+					self.data_sent += 1
+					self.send(msg_json['LDST'],msg_str)
 
-				# send a join message to all around me
-				self.sqnr += 1
-				msg_json = {}
-				msg_json['TYPE'] = 'JOIN'
-				msg_json['SRC']  = self.id
-				msg_json['DST']  = 0
-				msg_json['LSRC'] = self.id
-				msg_json['LDST'] = 0
-				msg_json['RNK'] = self.rank
-				msg_json['SEQ']  = self.sqnr
-				msg_str = json.dumps( msg_json )
-				if (DEBUG_ADVERT):
-					print(self.env.now,':', self.id ,'sending advert' , msg_str)
-				self.send(msg_json['LDST'],msg_str)
+				if not ADVERT_TRICKLE:
+					self.advert()
 
+	def select_parent(self):
+		# choose the neighbour with the lowest path ETX, switching only
+		# for a clear improvement, and return whether our rank or
+		# parent changed
+		old_rank, old_parent, old_root = self.rank, self.join_node, self.root
+		parent = self.neighbours.get(self.join_node)
+		if self.join_node != 0 and (parent is None or parent.rank == 0):
+			# the parent is gone or detached itself, for a while only
+			# nodes closer to the sink than we were cannot be our own
+			# descendants
+			self.hold_rank = self.rank - 1
+			self.hold_until = self.env.now + NBR_HOLD
+			self.join_node = 0
+			self.rank = 0
+			self.path_etx = 0.0
+			self.root = 0
+			parent = None
+		if self.join_node != 0:
+			# only nodes closer to the sink, a node of our own rank may
+			# pick one of our children once we joined it
+			limit = self.rank - 1
+		elif self.env.now < self.hold_until:
+			limit = self.hold_rank
+		else:
+			limit = None
+		best = parent
+		for nbr in self.neighbours.values():
+			if nbr.rank == 0 or nbr is parent:
+				continue
+			if limit is not None and nbr.rank > limit:
+				continue
+			if best is None or (nbr.metric(), nbr.rank) < (best.metric(), best.rank):
+				best = nbr
+		if best is not parent and parent is not None and best.metric() > parent.metric() - NBR_HYSTERESIS:
+			best = parent
+		if best is not None:
+			if best is not parent and (DEBUG_ADVERT):
+				print(self.env.now,':', self.id ,'joining node' , best.id, 'rank:', self.rank, '->', best.rank + 1, 'etx: %.2f' % best.metric())
+			self.join_node = best.id
+			self.rank = best.rank + 1
+			self.path_etx = best.metric()
+			self.root = best.root
+		elif old_parent != 0:
+			# advertise rank 0 so that our children detach as well
+			if (DEBUG_ADVERT):
+				print(self.env.now,':', self.id ,'lost parent' , old_parent, 'detaching')
+			self.advert()
+		if self.rank != old_rank or self.join_node != old_parent or self.root != old_root:
+			self.rank_changed()
+			return True
+		return False
+
+	def aggregate(self, msg_json):
+		# hold the readings of a reading or combined message until the
+		# aggregation window ends
+		if msg_json['TYPE'] == 'TEMP':
+			read = [[msg_json['SRC'], msg_json['SEQ'], msg_json['DATA'], msg_json['OT'], msg_json['HOPS'], msg_json['ORNK']]]
+		elif 'READ' in msg_json:
+			# entries count the hops up to the node that combined them
+			read = [entry[:4] + [entry[4] + msg_json['HOPS']] + entry[5:] for entry in msg_json['READ'] if not self.seen.check(entry[0], entry[1])]
+		else:
+			read = None
+		if AGG_MODE == 'summary':
+			if read is None:
+				low, high, total, count = msg_json['SUM']
+			else:
+				values = [float(str(entry[2]).split(' ')[0]) for entry in read]
+				low, high, total, count = min(values), max(values), sum(values), len(values)
+			if self.agg_sum is None:
+				self.agg_sum = [low, high, total, count]
+			else:
+				self.agg_sum = [min(self.agg_sum[0], low), max(self.agg_sum[1], high), self.agg_sum[2] + total, self.agg_sum[3] + count]
+		else:
+			count = len(read)
+			self.agg_read.extend(read)
+		if count == 0:
+			return
+		self.agg_held.append((self.env.now, count))
+		self.agg_ttl = min(self.agg_ttl, msg_json['TTL'])
+		if sum(held[1] for held in self.agg_held) >= AGG_MAX:
+			self.agg_flush()
+		elif not self.agg_timer:
+			self.agg_timer = True
+			self.env.process(self.agg_p())
+
+	def agg_p(self):
+		yield self.env.timeout(AGG_WINDOW)
+		self.agg_timer = False
+		if self.agg_held:
+			if self.join_node == 0 or not self.alive:
+				# wait for a parent before sending
+				self.agg_timer = True
+				self.env.process(self.agg_p())
+			else:
+				self.agg_flush()
+
+	def agg_flush(self):
+		readings = 0
+		for arrival, count in self.agg_held:
+			readings += count
+			self.agg_hold += (self.env.now - arrival) * count
+		self.agg_readings += readings
+		self.agg_messages += 1
+		msg_json = {}
+		if AGG_MODE != 'summary' and len(self.agg_read) == 1:
+			# a single reading is sent as it is
+			src, seq, data, origin, hops, rank = self.agg_read[0]
+			msg_json['TYPE'] = 'TEMP'
+			msg_json['SRC']  = src
+			msg_json['SEQ']  = seq
+			msg_json['OT']   = origin
+			msg_json['HOPS'] = hops
+			msg_json['ORNK'] = rank
+			msg_json['DATA'] = data if src == self.id else str(data) + ' via ' + str(self.id)
+		else:
+			self.sqnr += 1
+			msg_json['TYPE'] = 'AGGR'
+			msg_json['SRC']  = self.id
+			msg_json['SEQ']  = self.sqnr
+			msg_json['HOPS'] = 0
+			if AGG_MODE == 'summary':
+				msg_json['SUM'] = self.agg_sum
+			else:
+				msg_json['READ'] = [[src, seq, data if src == self.id else str(data) + ' via ' + str(self.id), origin, hops, rank] for src, seq, data, origin, hops, rank in self.agg_read]
+		msg_json['DST']  = self.root
+		msg_json['LSRC'] = self.id
+		msg_json['LDST'] = self.join_node
+		msg_json['TTL']  = self.agg_ttl
+		msg_json['LRNK'] = self.rank
+		msg_str = json.dumps( msg_json )
+		if (DEBUG_ROUTE):
+			print(self.env.now,':', self.id ,'sending combined readings' , msg_str)
+		self.agg_read = []
+		self.agg_sum = None
+		self.agg_held = []
+		self.agg_ttl = ROUTE_MAX_HOPS
+		self.data_sent += 1
+		self.send(msg_json['LDST'],msg_str)
+
+	def repair(self, sender):
+		# the sender of a reading should be below us in the tree
+		self.loops += 1
+		if sender == self.join_node:
+			# we and our parent point at each other, find another parent
+			if (DEBUG_ROUTE):
+				print(self.env.now,':', self.id ,'loop with parent' , sender)
+			self.neighbours.pop(sender, None)
+			self.select_parent()
+		if ADVERT_TRICKLE:
+			# let the sender learn our rank quickly
+			self.trickle_reset()
+
+	def link_failed(self, ldst):
+		# a neighbour that misses all retransmissions is a bad parent
+		nbr = self.neighbours.get(ldst)
+		if nbr is not None:
+			nbr.prr *= (1 - NBR_ALPHA) ** (LINK_ACK_RETRIES + 1)
+			if ldst == self.join_node:
+				self.select_parent()
+
+	def evict(self):
+		# forget neighbours that have not been heard for too long
+		stale = [nbr.id for nbr in self.neighbours.values() if self.env.now - nbr.last_heard > NBR_TIMEOUT]
+		for id in stale:
+			if (DEBUG_ADVERT):
+				print(self.env.now,':', self.id ,'evicting neighbour' , id)
+			del self.neighbours[id]
+		parent = self.neighbours.get(self.join_node)
+		if parent is not None and parent.rank > 1 and not MAC_DUTY_CYCLE and self.env.now - parent.last_heard > NBR_PARENT_TIMEOUT:
+			# a parent forwards our readings and sends its own, we overhear
+			# it every reading period while it is alive. Sleeping nodes do
+			# not overhear and sinks hardly send, both wait for NBR_TIMEOUT
+			if (DEBUG_ADVERT):
+				print(self.env.now,':', self.id ,'parent silent' , parent.id)
+			del self.neighbours[parent.id]
+		if self.join_node != 0 and self.join_node not in self.neighbours:
+			self.select_parent()
+
+	def solicit(self):
+		# ask the nodes around me for adverts
+		self.sqnr += 1
+		msg_json = {}
+		msg_json['TYPE'] = 'SOLICIT'
+		msg_json['SRC']  = self.id
+		msg_json['DST']  = 0
+		msg_json['LSRC'] = self.id
+		msg_json['LDST'] = 0
+		msg_json['SEQ']  = self.sqnr
+		msg_str = json.dumps( msg_json )
+		if (DEBUG_ADVERT):
+			print(self.env.now,':', self.id ,'sending solicitation' , msg_str)
+		self.ctrl_sent += 1
+		self.send(msg_json['LDST'],msg_str)
 
 	def receive_p(self):
 		while True:
@@ -178,34 +1368,380 @@ class Sensor(Node):
 				if (DEBUG_INFO):
 					print(self.env.now,':', self.id ,'receiving' , msg_str)
 				msg_json = json.loads(msg_str)
+				if not self.link_receive(msg_json):
+					continue
 				if msg_json['TYPE'] == 'JOIN':
-					if self.join_node == 0 :
-						if (DEBUG_ADVERT):
-							print(self.env.now,':', self.id ,'joining node' , msg_json['SRC'], 'rank:', self.rank, '->', msg_json['RNK'] + 1)
-						self.join_node = msg_json['SRC']
-						self.rank = msg_json['RNK'] + 1
-					else:
-						if (DEBUG_ADVERT):
-							print(self.env.now,':', self.id ,'join received for rank' , msg_json['RNK'] )
-						if (msg_json['RNK'] + 1 < self.rank):
-							if (DEBUG_ADVERT):
-								print(self.env.now,':', self.id ,'joining node' , msg_json['SRC'], 'rank:', self.rank, '->', msg_json['RNK'] + 1)
-							self.join_node = msg_json['SRC']
-							self.rank = msg_json['RNK'] + 1
-				elif msg_json['TYPE'] == 'TEMP':	
+					if (DEBUG_ADVERT and self.join_node != 0):
+						print(self.env.now,':', self.id ,'join received for rank' , msg_json['RNK'] )
+					nbr = self.neighbours.get(msg_json['SRC'])
+					if nbr is None:
+						nbr = Neighbour(msg_json['SRC'], self.env.now)
+						self.neighbours[nbr.id] = nbr
+					nbr.advert(msg_json, self.env.now)
+					if not self.select_parent():
+						self.trickle_consistent()
+				elif msg_json['TYPE'] == 'SOLICIT':
+					if self.join_node != 0:
+						self.trickle_reset()
+				elif msg_json['TYPE'] == 'TEMP' or msg_json['TYPE'] == 'AGGR':
 					if self.join_node == 0:
 						print(self.env.now,':', self.id ,'cannot route messages, not joined a topology yet')
+					elif self.seen.check(msg_json['SRC'], msg_json['SEQ']):
+						if (DEBUG_ROUTE):
+							print(self.env.now,':', self.id ,'dropping duplicate' , msg_str)
+					elif msg_json['TTL'] <= 1:
+						self.ttl_expired += 1
+						if (DEBUG_ROUTE):
+							print(self.env.now,':', self.id ,'hop limit reached' , msg_str)
+					elif msg_json['LRNK'] <= self.rank and msg_json.get('RERR'):
+						# a second inconsistency on the way, the reading is looping
+						self.repair(msg_json['LSRC'])
+						if (DEBUG_ROUTE):
+							print(self.env.now,':', self.id ,'dropping looping reading' , msg_str)
 					else:
+						if msg_json['LRNK'] <= self.rank:
+							# readings travel towards lower ranks, coming from a
+							# node that is not below us means a loop may exist
+							self.repair(msg_json['LSRC'])
+							msg_json['RERR'] = 1
+						msg_json['TTL'] -= 1
+						msg_json['HOPS'] += 1
+						if AGG_ENABLED:
+							self.aggregate(msg_json)
+							continue
+						msg_json['LRNK'] = self.rank
 						msg_json['LSRC'] = self.id
 						msg_json['LDST'] = self.join_node
 						msg_json['DATA'] = str(msg_json['DATA']) + ' via ' + str(self.id)
 						msg_str = json.dumps( msg_json )
 						if (DEBUG_ROUTE):
 							print(self.env.now,':', self.id ,'routing' , msg_str)
+						self.data_sent += 1
 						self.send(msg_json['LDST'],msg_str)
 					
 
 
+# Injected faults: node failures and revivals, partitions, lossy links
+# and moving nodes. All of them, scheduled or random, wait in one heap
+# of (time, order, action, arguments) served by a single process, random
+# failures put the next one into the heap when they happen. The readings
+# delivered to the sinks are counted per FAULT_WINDOW to measure the
+# throughput lost while faults are active.
+class Faults(object):
+	def __init__(self, env):
+		self.env = env
+		self.heap = []
+		self.order = 0
+		self.wakeup = None
+		self.nodes = {}
+		self.region = {} # node id -> group, empty without partition
+		self.links = {}  # (src, dst) -> loss rate
+		self.down = set() # nodes failed by us
+		self.applied = {}
+		self.first = None # time of the first fault
+		self.disturbed = False
+		self.windows = [] # [end, readings, live nodes, disturbed]
+
+	def start(self, nodes, schedule=FAULT_SCHEDULE):
+		self.nodes = {node.id: node for node in nodes}
+		for entry in schedule:
+			self.at(entry[0], entry[1], *entry[2:])
+		if FAULT_CHURN:
+			self.at(FAULT_CHURN_FROM + expovariate(1.0 / FAULT_CHURN), 'churn')
+		self.env.process(self.run_p())
+		self.env.process(self.window_p())
+
+	def at(self, when, action, *args):
+		heapq.heappush(self.heap, (when, self.order, action, args))
+		self.order += 1
+		if self.heap[0][1] == self.order - 1 and self.wakeup and not self.wakeup.triggered:
+			self.wakeup.succeed()
+
+	def run_p(self):
+		while True:
+			self.wakeup = self.env.event()
+			if not self.heap:
+				yield self.wakeup
+				continue
+			if self.heap[0][0] > self.env.now:
+				yield self.env.timeout(self.heap[0][0] - self.env.now) | self.wakeup
+				continue
+			when, order, action, args = heapq.heappop(self.heap)
+			if (DEBUG_FAULT):
+				print(self.env.now,': fault', action, *args)
+			if getattr(self, action)(*args) is not False:
+				self.applied[action] = self.applied.get(action, 0) + 1
+				if self.first is None:
+					self.first = self.env.now
+				self.disturbed = True
+
+	def window_p(self):
+		last = 0
+		while True:
+			self.disturbed = self.active()
+			yield self.env.timeout(FAULT_WINDOW)
+			received = sum(node.received for node in self.nodes.values() if isinstance(node, Sink))
+			live = len([node for node in self.nodes.values() if node.alive])
+			self.windows.append([self.env.now, received - last, live, self.disturbed])
+			last = received
+
+	def active(self):
+		return bool(self.down or self.region or self.links)
+
+	def cut(self, src, dst):
+		return bool(self.region) and self.region.get(src) != self.region.get(dst)
+
+	def loss(self, src, dst):
+		return self.links.get((src, dst), RADIO_LOSSRATE)
+
+	def kill(self, id):
+		node = self.nodes[id]
+		if not node.alive:
+			return False
+		node.deplete()
+		node.failures += 1
+		if node.energy:
+			node.energy.radio(node.eidx, 0)
+		self.down.add(id)
+
+	def revive(self, id):
+		node = self.nodes[id]
+		if node.alive:
+			return False
+		node.revive()
+		self.down.discard(id)
+
+	def partition(self, *groups):
+		# nodes not listed in a group form one more group
+		self.region = {id: 0 for id in self.nodes}
+		for number, group in enumerate(groups):
+			for id in group:
+				self.region[id] = number + 1
+
+	def heal(self):
+		self.region = {}
+
+	def link(self, a, b, loss):
+		for key in ((a, b), (b, a)):
+			if loss is None:
+				self.links.pop(key, None)
+			else:
+				self.links[key] = loss
+
+	def move(self, id, posx, posy):
+		self.nodes[id].posx = posx
+		self.nodes[id].posy = posy
+
+	def churn(self):
+		# a random live sensor fails and is revived after a random downtime
+		sensors = [node for node in self.nodes.values() if isinstance(node, Sensor) and node.alive]
+		self.at(self.env.now + expovariate(1.0 / FAULT_CHURN), 'churn')
+		if not sensors:
+			return False
+		node = sensors[randint(0, len(sensors) - 1)]
+		self.kill(node.id)
+		self.at(self.env.now + expovariate(1.0 / FAULT_DOWNTIME), 'revive', node.id)
+
+
+# Summary of the duty cycling of all nodes
+def mac_report(nodes):
+	print(env.now,': mac report')
+	for node in nodes:
+		delay = node.mac_delay / node.mac_delivered if node.mac_delivered else 0
+		print('  node', node.id, 'wakeups', node.mac_wakeups, 'frames', node.mac_frames, 'strobes', node.mac_strobes, 'delivered', node.mac_delivered, 'mean unicast delay %.1f' % delay)
+
+
+# Summary of the transmit queues, nodes with the longest queues first
+def csma_report(nodes):
+	print(env.now,': csma report')
+	for node in sorted(nodes, key=lambda node: -node.txq_area):
+		node.queue_changed()
+		mean = node.txq_area / env.now if env.now else 0
+		print('  node', node.id, 'rank', node.rank, 'sent', node.txq_sent, 'dropped', node.txq_dropped, 'queue mean %.3f max %d' % (mean, node.txq_max), 'backoffs', node.backoffs, 'backoff time %.1f' % node.backoff_time)
+
+
+# Summary of the control traffic and the convergence of the ranks
+def control_report(nodes):
+	print(env.now,': control report')
+	ctrl = sum(node.ctrl_sent for node in nodes)
+	data = sum(node.data_sent for node in nodes)
+	for node in nodes:
+		joined = round(node.joined_at, 1) if node.joined_at is not None else None
+		changed = round(node.rank_changed_at, 1) if node.rank_changed_at is not None else None
+		print('  node', node.id, 'rank', node.rank, 'root', node.root, 'etx %.2f' % node.path_etx, 'control', node.ctrl_sent, 'data', node.data_sent, 'joined at', joined, 'last rank change', changed)
+	print('  control', ctrl, 'data', data, 'control share %.2f' % (ctrl / (ctrl + data) if ctrl + data else 0))
+
+
+# Readings delivered to every sink and the sensors in its tree
+def sink_report(nodes):
+	print(env.now,': sink report')
+	for sink in nodes:
+		if isinstance(sink, Sink):
+			tree = [node.id for node in nodes if node.root == sink.id and node is not sink]
+			print('  sink', sink.id, 'received', sink.received, 'load %.3f' % sink.load, 'sensors', tree)
+	print('  total received', sum(sink.received for sink in nodes if isinstance(sink, Sink)))
+
+
+# Latency percentiles of the readings by rank of the source and by source
+def latency_report(nodes):
+	print(env.now,': latency report')
+	for sink in nodes:
+		if isinstance(sink, Sink) and sink.latency.count:
+			metrics = sink.metrics()
+			stats = metrics['latency']
+			print('  sink', sink.id, 'readings', stats['count'], 'mean %.2f p50 %.2f p90 %.2f p99 %.2f max %.2f' % (stats['mean'], stats['p50'], stats['p90'], stats['p99'], stats['max']))
+			for rank in sorted(metrics['rank']):
+				stats = metrics['rank'][rank]
+				print('    rank', rank, 'readings', stats['count'], 'p50 %.2f p99 %.2f' % (stats['p50'], stats['p99']))
+			for src in sorted(metrics['source']):
+				stats = metrics['source'][src]
+				print('    sensor', src, 'readings', stats['count'], 'hops %.2f' % metrics['hops'][src], 'p50 %.2f p99 %.2f' % (stats['p50'], stats['p99']))
+
+
+# Duplicates dropped by every node and the size of the caches
+def dedup_report(nodes):
+	print(env.now,': duplicate report')
+	for node in nodes:
+		stats = node.seen.stats()
+		print('  node', node.id, 'duplicates', stats['hits'], 'unique', stats['misses'], 'hit rate %.3f' % stats['hit_rate'], 'entries', stats['entries'], 'bytes', stats['bytes'])
+
+
+# Loops and hop limit expiries seen by every node
+def route_report(nodes):
+	print(env.now,': route report')
+	for node in nodes:
+		print('  node', node.id, 'loops', node.loops, 'ttl expired', node.ttl_expired)
+
+
+# Readings combined by every forwarder and the time they were held
+def aggregation_report(nodes):
+	print(env.now,': aggregation report')
+	for node in nodes:
+		if isinstance(node, Sink):
+			print('  sink', node.id, 'messages', node.data_frames, 'readings', node.received, 'messages per reading %.2f' % (node.data_frames / node.received if node.received else 0))
+		elif node.agg_messages:
+			print('  node', node.id, 'rank', node.rank, 'messages', node.agg_messages, 'readings', node.agg_readings, 'readings per message %.2f' % (node.agg_readings / node.agg_messages), 'mean hold %.1f' % (node.agg_hold / node.agg_readings))
+
+
+# Delivery ratio and overhead of the hop by hop acknowledgements
+def link_report(nodes):
+	print(env.now,': link report')
+	frames = ok = sent = 0
+	for node in nodes:
+		frames += node.ack_frames
+		ok += node.ack_ok
+		sent += node.ack_frames + node.retransmissions + node.ack_sent
+		if node.ack_frames or node.ack_sent:
+			print('  node', node.id, 'frames', node.ack_frames, 'acked', node.ack_ok, 'failed', node.ack_failed, 'pending full', node.ack_overflow, 'retransmissions', node.retransmissions, 'acks sent', node.ack_sent, 'delivery %.3f' % (node.ack_ok / node.ack_frames if node.ack_frames else 0))
+	print('  delivery ratio %.3f' % (ok / frames if frames else 0), 'transmissions per frame %.2f' % (sent / frames if frames else 0))
+
+
+# Readings delivered per window with and without active faults, the
+# first window is left out as the network is still forming
+def fault_report(faults):
+	print(env.now,': fault report')
+	print('  applied', ', '.join('%s %d' % (action, count) for action, count in sorted(faults.applied.items())) or 'none')
+	for end, readings, live, disturbed in faults.windows:
+		print('  window', end, 'readings', readings, 'live nodes', live, 'faults' if disturbed else '')
+	clean = [readings for end, readings, live, disturbed in faults.windows[1:] if not disturbed]
+	during = [readings for end, readings, live, disturbed in faults.windows[1:] if disturbed]
+	if clean and during:
+		before, after = sum(clean) / len(clean), sum(during) / len(during)
+		print('  readings per window %.1f without faults, %.1f with faults, throughput loss %.1f%%' % (before, after, 100.0 * (1 - after / before) if before else 0))
+	failed = [node for node in faults.nodes.values() if node.failures]
+	if failed:
+		print('  failures', ', '.join('node %d: %d' % (node.id, node.failures) for node in failed))
+
+
+# Nodes on a jittered square grid, spaced so that grid neighbours and
+# diagonals are in range, with a sink in the first corner and, for sink
+# failures, a second one at the last position. Diagonals are at most
+# sqrt(2) * (1 + 2 * jitter) * spacing = 0.99 RADIO_TXDISTANCE apart
+def topology(env, media, size, sinks=1):
+	side = int(math.ceil(math.sqrt(size)))
+	spacing = RADIO_TXDISTANCE / 1.5
+	jitter = 0.025
+	nodes = []
+	for i in range(size):
+		x = (i % side + uniform(-jitter, jitter)) * spacing
+		y = (i // side + uniform(-jitter, jitter)) * spacing
+		if i == 0 or (sinks > 1 and i == size - 1):
+			nodes.append(Sink(env, media, i + 1, x, y))
+		else:
+			nodes.append(Sensor(env, media, i + 1, x, y))
+	return nodes
+
+
+# Rank and root of every live sensor, parent switches between equally
+# ranked neighbours do not count as changes
+def ranks(nodes):
+	return [(node.id, node.rank, node.root) for node in nodes if isinstance(node, Sensor) and node.alive]
+
+
+# Live sensors whose parent is alive as well
+def attached(nodes):
+	byid = {node.id: node for node in nodes}
+	return [node for node in nodes if isinstance(node, Sensor) and node.alive and node.join_node in byid and byid[node.join_node].alive]
+
+
+# Remembers when the ranks of the live sensors last changed, or some
+# of them were not attached to a live parent
+def watch_p(env, nodes, state):
+	while True:
+		now = ranks(nodes)
+		if now != state['ranks'] or len(attached(nodes)) < len(now):
+			state['ranks'] = now
+			state['changed'] = env.now
+		yield env.timeout(BENCH_SAMPLE)
+
+
+# The sensor with the most nodes below it in the tree
+def busiest_relay(nodes):
+	byid = {node.id: node for node in nodes}
+	below = {}
+	for node in nodes:
+		parent, hops = getattr(node, 'join_node', 0), 0
+		while parent in byid and isinstance(byid[parent], Sensor) and hops < len(nodes):
+			below[parent] = below.get(parent, 0) + 1
+			parent, hops = byid[parent].join_node, hops + 1
+	return byid[max(below, key=below.get)] if below else None
+
+
+# Runs the JOIN protocol over topologies of growing size on a simulated
+# clock, then fails a relay or a sink and measures the re-convergence
+def convergence_benchmark(sizes=BENCH_SIZES, failure=BENCH_FAILURE):
+	print('convergence benchmark, trickle', ADVERT_TRICKLE, 'failure', failure)
+	for size in sizes:
+		bench = simpy.Environment()
+		state = {'ranks': None, 'changed': 0.0}
+		with open(os.devnull, 'w') as quiet, contextlib.redirect_stdout(quiet):
+			nodes = topology(bench, Media(bench), size, 2 if failure == 'sink' else 1)
+			bench.process(watch_p(bench, nodes, state))
+			bench.run(until=BENCH_FAIL_AT)
+		sensors = [node for node in nodes if isinstance(node, Sensor)]
+		first = sorted(node.joined_at for node in sensors if node.joined_at is not None)
+		control = sum(node.ctrl_sent for node in nodes)
+		print('  nodes', size, 'joined', len(attached(nodes)), '/', len(sensors),
+			'first join p50 %.1f' % first[len(first) // 2] if first else 'first join -',
+			'all joined %.1f' % first[-1] if len(first) == len(sensors) else 'all joined -',
+			'stable ranks %.1f' % state['changed'], 'control', control)
+		if failure is None:
+			continue
+		failed = nodes[0] if failure == 'sink' else busiest_relay(nodes)
+		if failed is None:
+			continue
+		failed.deplete()
+		state['ranks'] = ranks(nodes)
+		state['changed'] = bench.now
+		with open(os.devnull, 'w') as quiet, contextlib.redirect_stdout(quiet):
+			bench.run(until=BENCH_UNTIL)
+		# children still pointing at the failed node have not noticed it yet
+		alive = [node for node in sensors if node.alive]
+		joined = attached(nodes)
+		print('    %s %d failed:' % (failure, failed.id), 'joined', len(joined), '/', len(alive),
+			're-converged in %.1f' % (state['changed'] - BENCH_FAIL_AT) if len(joined) == len(alive) else 'not re-converged', 'control', sum(node.ctrl_sent for node in nodes) - control)
+
+
 # Start of main program
 # Initialisation of the random generator
 seed(datetime.now())
@@ -218,15 +1754,56 @@ env = simpy.rt.RealtimeEnvironment(factor=0.01, strict=False)
 # the communication medium
 media = Media(env)
 
+# the battery of all nodes
+energy = Energy(env, ENERGY_BATTERY)
+
+# recorded readings replayed by the sensors
+trace = Trace(SENSOR_SOURCE) if SENSOR_SOURCE else None
+
+# columnar record of the radio events
+recorder = Recorder(env, EVENTS) if EVENTS else None
+
+# injected node failures, partitions and lossy links
+faults = Faults(env) if FAULTS else None
+
+if BENCHMARK:
+	convergence_benchmark()
+	sys.exit(0)
+
 # Nodes placed in a 2 dimensional space
-# Node(env, media, node_id, position_x, position_y)
-Sink(env,media,1,1,0)
-Sensor(env,media,2,0,1)
-Sensor(env,media,3,0,2)
-Sensor(env,media,4,0,3)
-Sensor(env,media,5,2,1)
-Sensor(env,media,6,2,2)
-Sensor(env,media,7,2,3)
+# Node(env, media, node_id, position_x, position_y, energy)
+nodes = [
+	Sink(env,media,1,1,0,energy),
+	Sensor(env,media,2,0,1,energy),
+	Sensor(env,media,3,0,2,energy),
+	Sensor(env,media,4,0,3,energy),
+	Sensor(env,media,5,2,1,energy),
+	Sensor(env,media,6,2,2,energy),
+	Sensor(env,media,7,2,3,energy),
+	# a second gateway at the far end shares the load of the first one
+	#Sink(env,media,8,1,4,energy),
+]
+if faults:
+	faults.start(nodes)
 
 # Duration of the experiment
 env.run(until=6000)
+sink_report(nodes)
+latency_report(nodes)
+dedup_report(nodes)
+route_report(nodes)
+if LINK_ACK:
+	link_report(nodes)
+if AGG_ENABLED:
+	aggregation_report(nodes)
+control_report(nodes)
+energy.report()
+if faults:
+	fault_report(faults)
+if MAC_DUTY_CYCLE:
+	mac_report(nodes)
+if MAC_CSMA:
+	csma_report(nodes)
+if recorder:
+	recorder.close()
+	events_report(EVENTS)